@@ -1,7 +1,31 @@
+import functools
+import heapq
+import inspect
+import json
+import math
+from collections import OrderedDict
+import os
 import numpy as np
 import random as rn
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 import unit_test as ut
+import yaml_functions as yf
+
+
+default_chunk_size = 1024
+default_memory_budget = 256 * 2 ** 20  # bytes of (addresses, hard locations) arrays built by each batch chunk
+default_block_size = 4096  # hard locations scanned by each task in threaded mode
+initialization_chunk_size = 65536  # hard locations generated at once by Random/Uniform creation
+default_calibration_samples = 1000  # hard locations sampled to calibrate the radius
+default_calibration_probes = 100
+
+k_header_file    = 'sdm.yaml'
+k_addresses_file = 'addresses.npy'
+k_counters_file  = 'counters.npy'
 
 
 class HardLocationCreation(IntEnum):
@@ -11,20 +35,151 @@ class HardLocationCreation(IntEnum):
     OnDemand  = 3
 
 
+class EvictionPolicy(IntEnum):
+    Random         = 0
+    LRU            = 1  # least recently read or written
+    LFU            = 2  # least frequently read or written
+    LeastActivated = 3  # lowest counters magnitude
+
+
+class ReadMode(IntEnum):
+    Radius   = 0  # all the hard locations within radius
+    KNearest = 1  # the read_k nearest hard locations, no matter how far
+    Sampled  = 2  # at most read_k hard locations sampled from the ones within radius
+
+
+def instrumented(operation):
+    """
+    Decorator of SDM methods whose latency is recorded in sdm.stats (only one attribute check if stats are off)
+    :param operation: name of the operation in the stats
+    :return:
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            stats = self.stats
+            if stats is None:
+                return method(self, *args, **kwargs)
+            start  = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            stats.record_latency(operation, time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+class Histogram(object):
+    """
+    Histogram with power of 2 buckets: recording a value is O(1) and percentiles are estimated by the upper limit
+    of their bucket
+    """
+
+    def __init__(self):
+        self.count   = 0
+        self.total   = 0.0
+        self.max     = 0.0
+        self.buckets = {}  # exponent -> number of values in (2^(exponent-1), 2^exponent]
+
+    def add(self, value):
+        exponent               = math.frexp(value)[1] if value > 0 else 0
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+        self.count            += 1
+        self.total            += value
+        self.max               = max(self.max, value)
+
+    def get_percentile(self, percentile):
+        """
+        Returns the upper limit of the bucket with the given percentile (0-100) of the values
+        :param percentile:
+        :return:
+        """
+        accumulated = 0
+        for exponent in sorted(self.buckets):
+            accumulated += self.buckets[exponent]
+            if accumulated >= percentile / 100.0 * self.count:
+                return min(float(2 ** exponent), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count':     self.count,
+                'total':     self.total,
+                'mean':      self.total / self.count if self.count else 0.0,
+                'max':       self.max,
+                'p50':       self.get_percentile(50),
+                'p99':       self.get_percentile(99),
+                'histogram': {2 ** exponent: self.buckets[exponent] for exponent in sorted(self.buckets)}}
+
+
+class SDMStats(object):
+    """
+    Counters (ex: distance evaluations, hard locations allocated/evicted), latency histograms (in microseconds) of
+    the main operations and histograms of values (ex: hard locations activated by each read)
+    """
+
+    def __init__(self, hook=None):
+        """
+        :param hook: optional function(operation, seconds) called after each timed operation
+        """
+        self.hook      = hook
+        self.counters  = {}
+        self.latencies = {}
+        self.values    = {}
+
+    def reset(self):
+        self.counters  = {}
+        self.latencies = {}
+        self.values    = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_latency(self, operation, seconds):
+        if operation not in self.latencies:
+            self.latencies[operation] = Histogram()
+        self.latencies[operation].add(seconds * 1e6)
+        if self.hook is not None:
+            self.hook(operation, seconds)
+
+    def record_value(self, name, value):
+        if name not in self.values:
+            self.values[name] = Histogram()
+        self.values[name].add(value)
+
+    def snapshot(self):
+        """
+        Returns a copy of all the stats as a dictionary (latencies in microseconds)
+        :return:
+        """
+        return {'counters':  dict(self.counters),
+                'latencies': {operation: histogram.snapshot() for operation, histogram in self.latencies.items()},
+                'values':    {name: histogram.snapshot() for name, histogram in self.values.items()}}
+
+
 class Address(object):
     """
-    To be used as an address in an SDM
+    To be used as an address in an SDM. Instances only keep their value and length (no per instance dictionary),
+    every SDM can use addresses of its own length and iterating over an address is re-entrant
     """
-    address_length = 10
+    __slots__      = ('value', 'length')
+    address_length = 10  # default length of create_address_from_number
 
     @staticmethod
     def create_random(length):
         return ''
 
     @staticmethod
-    def create_address_from_number(i):
+    def create_address_from_number(i, length=None):
         return Address('0')
 
+    @staticmethod
+    def create_from_digits(digits):
+        """
+        Returns the address with a vector of digits (one value per dimension)
+        :param digits:
+        :return:
+        """
+        return Address(digits.tolist())
+
     @staticmethod
     def get_null_value(length):
         return ''
@@ -37,40 +192,78 @@ class Address(object):
     def get_value_from_counters(counters):
         return counters
 
+    @staticmethod
+    def get_null_array(length):
+        return np.zeros(length)
+
+    @staticmethod
+    def get_digits(address):
+        """
+        Returns the vector of digits (one value per dimension) of address (a raw value or an Address)
+        :param address:
+        :return:
+        """
+        return np.asarray(address.value if isinstance(address, Address) else address)
+
+    @staticmethod
+    def create_near_digits(digits, distances, rng):
+        """
+        Returns random addresses near each row of digits, as digits
+        :param digits: (n, length) matrix, one address per row
+        :param distances: distance of each new address to its row
+        :param rng: numpy random Generator
+        :return:
+        """
+        return np.array(digits)
+
+    @staticmethod
+    def get_array_from_counters(counters):
+        """
+        Returns the values of one content (or a matrix with one content per row) from the mean of its counters as a
+        NumPy array, used by the SDMs with array_values
+        :param counters:
+        :return:
+        """
+        return np.asarray(counters)
+
     def __init__(self, value):
-        self.value     = value
-        self.current_i = 0
+        self.value  = value
+        self.length = len(value)
 
     def __iter__(self):
-        self.current_i = 0
-        return self
-
-    def __next__(self):
-        if self.current_i >= len(self.value):
-            raise StopIteration
-        value = self.value[self.current_i]
-        self.current_i += 1
-        return value
+        return iter(self.value)
+
+    def __len__(self):
+        return self.length
 
     def distance(self, other_address):
         return 0
 
-    def get_random_near_address(self, near_distance):
+    def get_random_near_address(self, near_distance, rng=None):
         """
         Returns a random address close to the original one (no longer than near_distance)
         :param near_distance:
+        :param rng: numpy random Generator (default: a new unseeded one)
         :return:
         """
-        pass
+        rng    = np.random.default_rng() if rng is None else rng
+        digits = self.create_near_digits(self.get_digits(self)[np.newaxis, :], np.array([near_distance]), rng)
+        return self.create_from_digits(digits[0])
 
     def __str__(self):
         return self.value
 
 
 class BinaryAddress(Address):
+    __slots__ = ()
+
+    @staticmethod
+    def create_address_from_number(i, length=None):
+        return BinaryAddress(np.binary_repr(i, width=BinaryAddress.address_length if length is None else length))
+
     @staticmethod
-    def create_address_from_number(i):
-        return BinaryAddress(np.binary_repr(i, width=Address.address_length))
+    def create_from_digits(digits):
+        return BinaryAddress((np.asarray(digits, dtype=np.uint8) + ord('0')).tobytes().decode())
 
     @staticmethod
     def get_null_value(length):
@@ -82,32 +275,42 @@ class BinaryAddress(Address):
 
     @staticmethod
     def get_value_from_counters(counters):
-        return ''.join(['1' if counter > 0.0 else '0' for counter in counters])
+        return bits_to_binary(BinaryAddress.get_array_from_counters(counters))
+
+    @staticmethod
+    def get_null_array(length):
+        return np.zeros(length, dtype=np.uint8)
+
+    @staticmethod
+    def get_array_from_counters(counters):
+        return (np.asarray(counters) > 0.0).astype(np.uint8)
 
     def __init__(self, value):
-        super().__init__(value)
+        """
+        :param value: binary string (ex: '0110') or vector of 0/1 values
+        """
+        super().__init__(bits_to_binary(value) if isinstance(value, np.ndarray) else value)
 
     def distance(self, other_address):
         return hamming_distance(self.value, other_address.value)
 
-    def get_random_near_address(self, near_distance):
+    @staticmethod
+    def get_digits(address):
+        value = address.value if isinstance(address, Address) else address
+        return np.asarray(value, dtype=np.uint8) if isinstance(value, np.ndarray) else binary_to_bits(str(value))
+
+    @staticmethod
+    def create_near_digits(digits, distances, rng):
         """
-        Returns a random address close to the original one (no longer than near_distance)
-        :param near_distance:
-        :return:
+        Flips exactly distances[i] different bits (all of them if it is longer) of each row
         """
-        new_address = ''
-        to_change = [rn.randint(0, Address.address_length - 1) for _ in range(near_distance)]
-        for i, bit in enumerate(self.value):
-            if i in to_change:
-                bit1 = '1' if bit == '0' else '0'
-            else:
-                bit1 = bit
-            new_address += bit1
-        return BinaryAddress(new_address)
+        digits = np.asarray(digits, dtype=np.uint8)
+        ranks  = rng.random(digits.shape).argsort(axis=1).argsort(axis=1)  # random order of the bits of each row
+        return digits ^ (ranks < np.asarray(distances)[:, np.newaxis]).astype(np.uint8)
 
 
 class IntegersAddress(Address):
+    __slots__ = ()
     min_value = 0
     max_value = 255
 
@@ -116,6 +319,10 @@ class IntegersAddress(Address):
         return IntegersAddress([rn.randint(IntegersAddress.min_value, IntegersAddress.max_value)
                                 for _ in range(length)])
 
+    @staticmethod
+    def create_from_digits(digits):
+        return IntegersAddress(digits.tolist())
+
     @staticmethod
     def get_null_value(length):
         return [0 for _ in range(length)]
@@ -126,7 +333,17 @@ class IntegersAddress(Address):
 
     @staticmethod
     def get_value_from_counters(counters):
-        return [IntegersAddress.get_value_in_range(value) for value in counters]
+        return IntegersAddress.get_array_from_counters(counters).tolist()
+
+    @staticmethod
+    def get_null_array(length):
+        return np.zeros(length, dtype=np.int64)
+
+    @staticmethod
+    def get_array_from_counters(counters):
+        # as get_value_in_range: truncated and clipped to the range
+        values = np.trunc(np.asarray(counters, dtype=float))
+        return np.clip(values, IntegersAddress.min_value, IntegersAddress.max_value).astype(np.int64)
 
     @staticmethod
     def get_value_in_range(value):
@@ -141,204 +358,1846 @@ class IntegersAddress(Address):
             distance += abs(value - other_address.value[i])
         return distance
 
-    def get_random_near_address(self, near_distance):
+    @staticmethod
+    def get_digits(address):
+        value = address.value if isinstance(address, Address) else address
+        return np.asarray(value, dtype=np.int64)
+
+    @staticmethod
+    def create_near_digits(digits, distances, rng):
         """
-        Returns a random address close to the original one (no farther than near_distance)
-        :param near_distance:
-        :return:
+        Splits distances[i] randomly among the elements of each row and adds or subtracts each part, in the
+        direction that stays in range when only one does. The L1 distance is exactly distances[i] unless a part
+        does not fit in either direction, then it is clipped (so it is never farther)
         """
-        new_address = []
-        k           = rn.randint(4, near_distance-1)  # number of elements to change
-        k           = min(len(self.value), k)
-        segments    = get_random_partition(near_distance, k)                   # value to change in each element
-        to_change   = [rn.randint(0, len(self.value) - 1) for _ in range(k)]  # item to change
-        for i, value in enumerate(self.value):
-            if i in to_change:
-                sign   = -1 if rn.random() < 0.5 else 1
-                value1 = self.get_value_in_range(value + sign * segments[i])
-            else:
-                value1 = value
-            new_address.append(value1)
-        return IntegersAddress(new_address)
+        values   = np.asarray(digits, dtype=np.int64)
+        length   = values.shape[1]
+        deltas   = rng.multinomial(np.asarray(distances, dtype=np.int64), np.full(length, 1.0 / length))
+        up       = IntegersAddress.max_value - values
+        down     = values - IntegersAddress.min_value
+        positive = (deltas <= up) & ((deltas > down) | (rng.random(values.shape) < 0.5))
+        return np.clip(values + np.where(positive, deltas, -deltas), IntegersAddress.min_value,
+                       IntegersAddress.max_value)
 
     def __str__(self):
         return ','.join([str(i) for i in self.value])
 
 
+class RealAddress(Address):
+    """
+    Vector of real values (ex: an embedding), used as content of the SDMs with float_content
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def create_random(length):
+        return RealAddress(np.random.standard_normal(length).astype(np.float32))
+
+    @staticmethod
+    def create_from_digits(digits):
+        return RealAddress(np.asarray(digits, dtype=np.float32))
+
+    @staticmethod
+    def get_null_value(length):
+        return np.zeros(length, dtype=np.float32)
+
+    @staticmethod
+    def get_value_to_increment_counter(value):
+        return value
+
+    @staticmethod
+    def get_value_from_counters(counters):
+        return np.asarray(counters, dtype=np.float32)
+
+    @staticmethod
+    def get_null_array(length):
+        return np.zeros(length, dtype=np.float32)
+
+    @staticmethod
+    def get_array_from_counters(counters):
+        return np.asarray(counters, dtype=np.float32)
+
+    def __init__(self, value):
+        super().__init__(np.asarray(value, dtype=np.float32))
+
+    def distance(self, other_address):
+        return float(np.abs(self.value - other_address.value).sum())
+
+    def __str__(self):
+        return ','.join([str(value) for value in self.value])
+
+
+class HardLocationEviction(object):
+    """
+    Chooses which hard locations to delete when the maximum is reached creating them on demand.
+    Per slot access metadata (last access and number of accesses) is updated with vector operations on each
+    read/write, candidates are kept in a heap with lazy updates: keys only grow for LRU/LFU so a popped entry whose
+    key is out of date is pushed again with the current one, and selecting a hard location is O(log N) amortized
+    """
+
+    def __init__(self, policy=EvictionPolicy.Random, rng=None):
+        """
+        :param policy: EvictionPolicy
+        :param rng: numpy random Generator used by the Random policy (default: a new unseeded one)
+        """
+        self.policy       = policy
+        self.rng          = np.random.default_rng() if rng is None else rng
+        self.clock        = 0
+        self.last_access  = np.zeros(0, dtype=np.int64)
+        self.access_count = np.zeros(0, dtype=np.int64)
+        self.versions     = np.zeros(0, dtype=np.int64)
+        self.heap         = []
+
+    def ensure_capacity(self, capacity):
+        added = capacity - len(self.versions)
+        if added <= 0:
+            return
+        self.last_access  = np.concatenate([self.last_access, np.zeros(added, dtype=np.int64)])
+        self.access_count = np.concatenate([self.access_count, np.zeros(added, dtype=np.int64)])
+        self.versions     = np.concatenate([self.versions, np.zeros(added, dtype=np.int64)])
+
+    def get_key(self, store, slot):
+        if self.policy == EvictionPolicy.LRU:
+            return int(self.last_access[slot]), 0
+        elif self.policy == EvictionPolicy.LFU:
+            return int(self.access_count[slot]), int(self.last_access[slot])
+        elif self.policy == EvictionPolicy.LeastActivated:
+            return float(self.get_magnitudes(store, [slot])[0]), int(self.last_access[slot])
+        raise Exception('%s eviction policy has no key' % self.policy)
+
+    @staticmethod
+    def get_magnitudes(store, slots):
+        """
+        Returns the sum of the absolute values of the counters of each slot (LeastActivated key)
+        :param store:
+        :param slots:
+        :return:
+        """
+        return np.abs(store.counters[slots].astype(float)).sum(axis=1)
+
+    def added(self, store, slot):
+        self.ensure_capacity(store.capacity())
+        self.clock                   += 1
+        self.last_access[slot]        = self.clock
+        self.access_count[slot]       = 0
+        self.versions[slot]          += 1
+        if self.policy != EvictionPolicy.Random:
+            heapq.heappush(self.heap, self.get_key(store, slot) + (int(self.versions[slot]), slot))
+            self.compact(store)
+
+    def added_many(self, store, slots):
+        """
+        Same as added for many slots at once
+        :param store:
+        :param slots:
+        :return:
+        """
+        self.ensure_capacity(store.capacity())
+        self.last_access[slots]  = self.clock + 1 + np.arange(len(slots))
+        self.clock              += len(slots)
+        self.access_count[slots] = 0
+        self.versions[slots]    += 1
+        if self.policy != EvictionPolicy.Random:
+            self.heap.extend(self.get_key(store, slot) + (int(self.versions[slot]), int(slot)) for slot in slots)
+            heapq.heapify(self.heap)
+            self.compact(store)
+
+    def removed(self, store, slot):
+        # its heap entries are discarded when popped (version does not match)
+        self.versions[slot] += 1
+
+    def touch(self, store, slots, counts=1, written=False):
+        """
+        Registers an access (read or write) to slots
+        :param store:
+        :param slots:
+        :param counts: number of accesses of each slot
+        :param written: True if the counters of slots were updated
+        :return:
+        """
+        if self.policy == EvictionPolicy.Random or len(slots) == 0:
+            return
+        self.clock                += 1
+        self.last_access[slots]    = self.clock
+        self.access_count[slots]  += counts
+        if self.policy == EvictionPolicy.LeastActivated and written:
+            # counters magnitude can decrease (arithmetic content), the heap needs an entry with the new key. Reads
+            # only make keys grow (last access), which select handles lazily
+            slots = np.asarray(slots, dtype=np.int64)
+            for magnitude, slot in zip(self.get_magnitudes(store, slots).tolist(), slots.tolist()):
+                heapq.heappush(self.heap, (magnitude, self.clock, int(self.versions[slot]), slot))
+            self.compact(store)
+
+    def select(self, store, n, protected):
+        """
+        Returns n slots to be deleted (or less if there are not enough), never the protected ones
+        :param store:
+        :param n:
+        :param protected: slots that must not be deleted
+        :return:
+        """
+        protected = set(int(slot) for slot in protected)
+        if self.policy == EvictionPolicy.Random:
+            return self.select_random(store, n, protected)
+        selected = []
+        skipped  = []
+        while len(selected) < n and len(self.heap) > 0:
+            entry   = heapq.heappop(self.heap)
+            key     = entry[:-2]
+            version = entry[-2]
+            slot    = entry[-1]
+            if version != self.versions[slot] or not store.occupied[slot] or slot in selected:
+                continue
+            current = self.get_key(store, slot)
+            if key < current:
+                heapq.heappush(self.heap, current + (version, slot))
+            elif key > current:
+                # out of date duplicate, there is another entry with the current key
+                continue
+            elif slot in protected:
+                skipped.append(entry)
+            else:
+                selected.append(slot)
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return selected
+
+    def select_random(self, store, n, protected, max_tries=100):
+        """
+        Random slots in use: the store is full when evicting, so a random slot is almost always a valid one
+        """
+        selected = set()
+        tries    = 0
+        while len(selected) < n and tries < max_tries:
+            slot   = int(self.rng.integers(store.end))
+            tries += 1
+            if store.occupied[slot] and slot not in protected:
+                selected.add(slot)
+        if len(selected) < n:
+            # unlucky (or almost everything protected): choose among all the valid ones
+            candidates = np.setdiff1d(store.get_slots(), list(protected | selected))
+            selected.update(int(slot) for slot in self.rng.choice(candidates, min(n - len(selected), len(candidates)),
+                                                                  replace=False))
+        return list(selected)
+
+    def compact(self, store, force=False):
+        """
+        Rebuilds the heap when it has too many out of date entries
+        :param store:
+        :param force: rebuild it anyway (ex: the store was loaded)
+        :return:
+        """
+        self.ensure_capacity(store.capacity())
+        if self.policy == EvictionPolicy.Random or (not force and len(self.heap) <= 4 * len(store) + 64):
+            return
+        self.heap = [self.get_key(store, slot) + (int(self.versions[slot]), int(slot)) for slot in store.get_slots()]
+        heapq.heapify(self.heap)
+
+
+class HardLocationStore(object):
+    """
+    Keeps the hard locations in preallocated matrices: one row of addresses and one of counters per slot.
+    Deleted slots go to a free list and are reused by the next insertions, so both are O(1) and the slot of a
+    hard location never changes while it is alive (it can be used as a key by indexes)
+    """
+
+    def __init__(self, capacity, content_length, address_width=None, address_dtype=object, counter_type=int,
+                 index=None, eviction=None, read_cache=None):
+        """
+        :param capacity: number of slots preallocated (the store grows if more are needed)
+        :param content_length:
+        :param address_width: columns used by an address, None if each address is a single (object) value
+        :param address_dtype:
+        :param counter_type:
+        :param index: optional index kept updated with every add/remove (see MultiIndexHashing)
+        :param eviction: optional HardLocationEviction kept updated with every add/remove
+        :param read_cache: optional ReadCache told about every hard location added
+        """
+        self.address_width = address_width
+        self.address_dtype = address_dtype
+        self.counter_type  = counter_type
+        self.index         = index
+        self.eviction      = eviction
+        self.read_cache    = read_cache
+        self.addresses     = np.zeros(self.get_addresses_shape(capacity), dtype=address_dtype)
+        self.counters      = np.zeros((capacity, content_length), dtype=counter_type)
+        self.occupied      = np.zeros(capacity, dtype=bool)
+        self.versions      = np.zeros(capacity, dtype=np.int64)  # bumped when a slot is updated or freed
+        self.generation    = 0  # bumped each time all the hard locations are replaced
+        self.free_slots    = []
+        self.end           = 0  # slots >= end were never used
+        self.size          = 0
+
+    def __len__(self):
+        return self.size
+
+    def get_addresses_shape(self, capacity):
+        return (capacity,) if self.address_width is None else (capacity, self.address_width)
+
+    def capacity(self):
+        return len(self.occupied)
+
+    def add(self, address):
+        """
+        Stores address (with counters in zero) in a free slot
+        :param address: already encoded address
+        :return: the slot used
+        """
+        if len(self.free_slots) > 0:
+            slot = self.free_slots.pop()
+        else:
+            if self.end == self.capacity():
+                self.grow(max(1, 2 * self.capacity()))
+            slot      = self.end
+            self.end += 1
+        self.addresses[slot] = address
+        self.counters[slot]  = 0
+        self.occupied[slot]  = True
+        self.size           += 1
+        if self.index is not None:
+            self.index.add(slot, self.addresses[slot])
+        if self.eviction is not None:
+            self.eviction.added(self, slot)
+        if self.read_cache is not None:
+            self.read_cache.added([slot])
+        return slot
+
+    def add_many(self, addresses):
+        """
+        Same as add for many addresses at once
+        :param addresses: already encoded addresses, one per row
+        :return: the slots used
+        """
+        n      = len(addresses)
+        reused = [self.free_slots.pop() for _ in range(min(n, len(self.free_slots)))]
+        new_n  = n - len(reused)
+        if self.end + new_n > self.capacity():
+            self.grow(max(self.end + new_n, 2 * self.capacity()))
+        slots     = np.concatenate([np.array(reused, dtype=np.int64), np.arange(self.end, self.end + new_n)])
+        self.end += new_n
+        self.addresses[slots] = addresses
+        self.counters[slots]  = 0
+        self.occupied[slots]  = True
+        self.size            += n
+        if self.index is not None:
+            for slot in slots:
+                self.index.add(int(slot), self.addresses[slot])
+        if self.eviction is not None:
+            self.eviction.added_many(self, slots)
+        if self.read_cache is not None:
+            self.read_cache.added(slots)
+        return slots
+
+    def remove(self, slot):
+        if not self.occupied[slot]:
+            return
+        if self.index is not None:
+            self.index.remove(slot, self.addresses[slot])
+        if self.eviction is not None:
+            self.eviction.removed(self, slot)
+        self.occupied[slot] = False
+        self.free_slots.append(slot)
+        self.size           -= 1
+        self.versions[slot] += 1  # the reads that used it are stale
+
+    def clear(self):
+        for slot in self.get_slots():
+            self.remove(slot)
+        self.free_slots  = []
+        self.end         = 0
+        self.generation += 1
+        if self.index is not None:
+            self.index.rebuild(self.addresses[:0])
+
+    def grow(self, capacity):
+        added          = capacity - self.capacity()
+        self.addresses = np.concatenate([self.addresses,
+                                         np.zeros(self.get_addresses_shape(added), dtype=self.address_dtype)])
+        self.counters  = np.concatenate([self.counters,
+                                         np.zeros((added, self.counters.shape[1]), dtype=self.counter_type)])
+        self.occupied  = np.concatenate([self.occupied, np.zeros(added, dtype=bool)])
+        self.versions  = np.concatenate([self.versions, np.zeros(added, dtype=np.int64)])
+
+    def updated(self, slots):
+        """
+        Records that the counters of slots changed (see ReadCache)
+        :param slots:
+        :return:
+        """
+        self.versions[slots] += 1
+
+    def get_slots(self):
+        """
+        Returns the slots in use
+        :return:
+        """
+        return np.flatnonzero(self.occupied[:self.end])
+
+    def set_arrays(self, addresses, counters):
+        """
+        Uses addresses and counters (ex: memory mapped from a file) as the content of the store, all slots in use
+        :param addresses:
+        :param counters:
+        :return:
+        """
+        self.addresses    = addresses
+        self.counters     = counters
+        self.counter_type = counters.dtype
+        self.occupied     = np.ones(len(counters), dtype=bool)
+        self.versions     = np.zeros(len(counters), dtype=np.int64)
+        self.generation  += 1
+        self.free_slots   = []
+        self.end          = len(counters)
+        self.size         = len(counters)
+        if self.index is not None:
+            self.index.rebuild(addresses)
+        if self.eviction is not None:
+            self.eviction.compact(self, force=True)
+
+
+class ReadCache(object):
+    """
+    Bounded (LRU) cache of the sums read for an address. Each entry remembers the slots it activated and their
+    versions, a write (or removing a hard location) only bumps the versions of the slots it updates so only the
+    entries using them become stale (checked when they are read). Adding hard locations only drops the entries
+    whose read they can change, replacing all of them (store generation) makes all entries stale
+    """
+
+    def __init__(self, size, get_read_changes):
+        """
+        :param size: maximum number of addresses kept
+        :param get_read_changes: function (addresses, slots) returning for each address if adding the hard locations
+                                 in slots can change its read (see SDM.get_read_changes)
+        """
+        self.size             = size
+        self.get_read_changes = get_read_changes
+        self.entries          = OrderedDict()
+        self.stats   = {}
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, store):
+        """
+        Returns (slots, sums) cached for key, None if not cached or stale
+        :param key:
+        :param store: HardLocationStore the entry was read from
+        :return:
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        slots, sums, versions, generation, _ = entry
+        if generation != store.generation or not np.array_equal(store.versions[slots], versions):
+            del self.entries[key]
+            self.stats['invalidations'] += 1
+            self.stats['misses']        += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return slots, sums
+
+    def put(self, key, store, slots, sums, address):
+        """
+        :param key:
+        :param store: HardLocationStore the entry was read from
+        :param slots: slots read
+        :param sums: sum of their counters
+        :param address: address read, to check if hard locations added later are near it
+        :return:
+        """
+        address           = address.copy() if isinstance(address, np.ndarray) else address
+        self.entries[key] = (slots, sums.copy(), store.versions[slots].copy(), store.generation, address)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Removes all entries, needed if counters are changed directly (not with write)
+        :return:
+        """
+        self.entries.clear()
+
+    def added(self, slots):
+        """
+        Removes the entries whose read can change with the hard locations added in slots
+        :param slots:
+        :return:
+        """
+        if len(self.entries) == 0:
+            return
+        keys    = list(self.entries)
+        changed = self.get_read_changes([self.entries[key][4] for key in keys], np.asarray(slots, dtype=np.int64))
+        for key, key_changed in zip(keys, changed):
+            if key_changed:
+                del self.entries[key]
+                self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        reads             = self.stats['hits'] + self.stats['misses']
+        stats             = dict(self.stats)
+        stats['size']     = len(self.entries)
+        stats['hit_rate'] = stats['hits'] / reads if reads else 0.0
+        return stats
+
+    def reset_stats(self):
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+
 class SDM(object):
     """
     Main class with the basic functionalities for any kind of SDM
     see: https://en.wikipedia.org/wiki/Sparse_distributed_memory
     """
+    address_dtype = object
 
     def __init__(self, address_length, content_length, number_of_hard_locations, radius, values_per_dimension=2,
                  hard_location_creation=HardLocationCreation.Random, min_near_hard_locations=3,
-                 address_class=Address, content_class=Address, debug=False):
+                 address_class=Address, content_class=Address, counter_type=int, index=None,
+                 eviction_policy=EvictionPolicy.Random, n_threads=None, read_cache_size=None, array_values=False,
+                 seed=None, debug=False):
+        """
+        :param counter_type: dtype of the counters (ex: np.int8 for binary contents), integer counters saturate at
+                             the limits of their type instead of wrapping
+        :param n_threads: if set, the hard locations are scanned in blocks by a pool of n_threads threads (only
+                          used by ArraySDM, whose NumPy kernels release the GIL). Blocks do not depend on
+                          n_threads and are reduced in order, so any number of threads gives the same result
+        :param read_cache_size: if set, the sums read for the last read_cache_size addresses are kept in a
+                                ReadCache and reused until a write changes one of their hard locations
+        :param array_values: if True contents are read as NumPy arrays (0/1 bits, integers or floats, read_many
+                             returns one row per address) instead of binary strings or lists
+        :param seed: seed of the random generator used to create hard locations, so they can be reproduced
+        """
         self.address_length           = address_length
         self.content_length           = content_length
         self.values_per_dimensions    = values_per_dimension
-        self.max_possible_values      = self.values_per_dimensions ** self.content_length
+        self.max_possible_values      = self.values_per_dimensions ** self.address_length
         self.number_of_hard_locations = number_of_hard_locations
         self.min_near_hard_locations  = min_near_hard_locations
         self.radius                   = radius
         self.hard_locations_creation  = hard_location_creation
 
-        self.address_class                = address_class
-        self.address_class.address_length = self.address_length
-        self.content_class                = content_class
-        self.content_class.address_length = self.content_length
+        self.address_class            = address_class
+        self.content_class            = content_class
+        self.array_values             = array_values
+
+        self.counter_type   = counter_type
+        self.seed           = seed
+        self.rng            = np.random.default_rng(seed)
+        self.use_index      = True  # set to False to compare against the linear scan with the same data
+        self.chunk_size     = default_chunk_size
+        self.memory_budget  = default_memory_budget
+        self.block_size     = default_block_size
+        self.n_threads      = n_threads
+        self.executor       = ThreadPoolExecutor(max_workers=n_threads) if n_threads else None
+        self.read_cache     = ReadCache(read_cache_size, self.get_read_changes) if read_cache_size else None
+        self.read_mode      = ReadMode.Radius
+        self.read_k         = None
+        self.stats          = None  # see enable_stats
+        self.calibration    = None  # see calibrate_radius
+        self.store          = HardLocationStore(number_of_hard_locations, content_length,
+                                                address_width=self.get_address_width(address_length),
+                                                address_dtype=self.address_dtype, counter_type=counter_type,
+                                                index=index,
+                                                eviction=HardLocationEviction(eviction_policy, rng=self.rng),
+                                                read_cache=self.read_cache)
+        self.initialize_hard_location(debug=debug)
+
+    @property
+    def hard_locations(self):
+        """
+        The hard locations as a list of (address, counters) tuples, counters are views of the store so can be
+        updated in place
+        """
+        return [(self.decode_address(self.store.addresses[slot]), self.store.counters[slot])
+                for slot in self.store.get_slots()]
+
+    @hard_locations.setter
+    def hard_locations(self, hard_locations):
+        self.store.clear()
+        for address, counters in hard_locations:
+            slot = self.store.add(self.encode_address(address))
+            self.store.counters[slot] = counters
+
+    @property
+    def index(self):
+        return self.store.index
+
+    @property
+    def addresses(self):
+        """
+        Addresses of all the slots ever used (check store.occupied)
+        """
+        return self.store.addresses[:self.store.end]
+
+    @property
+    def counters(self):
+        """
+        Counters of all the slots ever used (check store.occupied)
+        """
+        return self.store.counters[:self.store.end]
+
+    def get_address_width(self, address_length):
+        """
+        Returns the number of columns used to store an address of address_length, None if stored as an object
+        :param address_length:
+        :return:
+        """
+        return None
+
+    def encode_address(self, address):
+        """
+        Returns address (a raw value or an Address) as it is kept in the store
+        :param address:
+        :return:
+        """
+        return address if isinstance(address, Address) else self.address_class(address)
+
+    def decode_address(self, row):
+        """
+        Returns an Address from the way it is kept in the store
+        :param row:
+        :return:
+        """
+        return row
+
+    @property
+    def eviction(self):
+        return self.store.eviction
+
+    def enable_stats(self, hook=None):
+        """
+        Starts recording SDMStats (they can be enabled and disabled at any time)
+        :param hook: optional function(operation, seconds) called after each timed operation
+        :return:
+        """
+        if self.stats is None:
+            self.stats = SDMStats(hook)
+        else:
+            self.stats.hook = hook
+
+    def disable_stats(self):
+        self.stats = None
+
+    def get_stats(self):
+        """
+        Returns a snapshot of the stats (empty if they are not enabled)
+        :return:
+        """
+        return self.stats.snapshot() if self.stats is not None else {}
+
+    def reset_stats(self):
+        if self.stats is not None:
+            self.stats.reset()
 
-        self.hard_locations = self.initialize_hard_location(debug=debug)
+    def count(self, name, n=1):
+        if self.stats is not None:
+            self.stats.count(name, n)
 
+    @instrumented('write')
     def write(self, address, content):
-        near_hard_locations = self.get_hard_locations_in_distance(address, self.radius)
+        near_indexes = self.get_near_indexes(address, self.radius)
+        if self.stats is not None:
+            self.stats.record_value('write_activations', len(near_indexes))
         if self.hard_locations_creation == HardLocationCreation.OnDemand and \
-                len(near_hard_locations) < self.min_near_hard_locations:
-            self.create_hard_locations_on_demand(address, content, near_hard_locations, near_distance=self.radius)
+                len(near_indexes) < self.min_near_hard_locations:
+            self.create_hard_locations_on_demand(address, content, near_indexes, near_distance=self.radius)
         else:
-            for hard_location in near_hard_locations:
-                self.update_hard_location_counters(hard_location, content)
+            self.update_counters(near_indexes, content)
+        self.eviction.touch(self.store, near_indexes, written=True)
 
+    @instrumented('read')
     def read(self, address):
-        # print('read %s' % address)
-        counter = np.zeros(self.content_length, dtype=float)
-        total   = 0
-        for hard_location in self.get_hard_locations_in_distance(address, self.radius):
-            # print('      near hard location %s -> %s' % (hard_location[0], hard_location[1]))
-            total += 1
-            for i, value in enumerate(hard_location[1]):
-                counter[i] += value
-        if total > 0:
-            avg     = counter/total
-            content = self.content_class.get_value_from_counters(avg)
+        return self.get_value_from_sums(*self.read_sums(address))
+
+    def read_sums(self, address):
+        """
+        Returns the sum of the counters of the hard locations near address and how many they are, partial sums
+        (ex: from different shards) can be added before calling get_value_from_sums
+        :param address:
+        :return:
+        """
+        if self.read_cache is None:
+            near_indexes, sums = self.get_near_sums(address)
         else:
+            key   = get_cache_key(address)
+            entry = self.read_cache.get(key, self.store)
+            if entry is None:
+                near_indexes, sums = self.get_near_sums(address)
+                self.read_cache.put(key, self.store, near_indexes, sums, address)
+            else:
+                near_indexes, sums = entry
+        self.eviction.touch(self.store, near_indexes)
+        if self.stats is not None:
+            self.stats.record_value('read_activations', len(near_indexes))
+        return sums.copy(), len(near_indexes)
+
+    def get_read_changes(self, addresses, slots):
+        """
+        Returns for each address if adding the hard locations in slots can change what it reads: any of them is
+        near it, or always in KNearest mode
+        :param addresses:
+        :param slots:
+        :return: boolean vector
+        """
+        if self.read_mode == ReadMode.KNearest:
+            return np.ones(len(addresses), dtype=bool)
+        return np.array([np.any(self.get_distances(address, slots) <= self.radius) for address in addresses],
+                        dtype=bool)
+
+    def get_near_sums(self, address):
+        """
+        Returns the slots of the hard locations read for address (see ReadMode) and the sum of their counters
+        :param address:
+        :return:
+        """
+        near_indexes = self.get_read_indexes(address)
+        return near_indexes, self.counters[near_indexes].sum(axis=0)
+
+    def set_read_mode(self, read_mode, k=None):
+        """
+        Changes the hard locations used by read
+        :param read_mode: ReadMode
+        :param k: maximum number of hard locations read, needed by KNearest and Sampled
+        :return:
+        """
+        if read_mode != ReadMode.Radius and (k is None or k < 1):
+            raise Exception('Read mode %s needs k >= 1' % ReadMode(read_mode).name)
+        self.read_mode = ReadMode(read_mode)
+        self.read_k    = k
+        if self.read_cache is not None:
+            self.read_cache.clear()
+
+    def get_read_indexes(self, address):
+        """
+        Returns the slots of the hard locations to read for address according to read_mode
+        :param address:
+        :return:
+        """
+        if self.read_mode == ReadMode.KNearest:
+            return self.get_nearest_indexes(address, self.read_k)
+        near_indexes = self.get_near_indexes(address, self.radius)
+        if self.read_mode == ReadMode.Sampled and len(near_indexes) > self.read_k:
+            near_indexes = np.sort(self.rng.choice(near_indexes, self.read_k, replace=False))
+        return near_indexes
+
+    def get_nearest_indexes(self, address, k):
+        """
+        Returns the slots of the k hard locations nearest to address (on ties the lowest slots)
+        :param address:
+        :param k:
+        :return:
+        """
+        slots = self.store.get_slots()
+        if len(slots) <= k:
+            return slots
+        self.count('distance_evaluations', len(slots))
+        return np.sort(slots[get_smallest_positions(self.get_distances(address, slots), k)])
+
+    def calibrate_radius(self, target_activations=None, target_fraction=None, samples=default_calibration_samples,
+                         probes=default_calibration_probes, probe_addresses=None, recalibrate_every=None):
+        """
+        Sets the radius to the smallest one that activates (on average) target_activations hard locations, or
+        target_fraction of them. It is estimated with the histogram of distances between probe addresses and a sample
+        of the hard locations, so its cost does not depend on the number of hard locations
+        :param target_activations: mean number of hard locations near an address
+        :param target_fraction: mean fraction of the hard locations near an address (only one target can be set)
+        :param samples: maximum number of hard locations sampled
+        :param probes: number of probe addresses: random ones, or the addresses of sampled hard locations if they are
+                       created on demand (as they follow the addresses written)
+        :param probe_addresses: addresses to use as probes instead (ex: some of the data to write)
+        :param recalibrate_every: if set, with hard locations created on demand the radius is calibrated again (with
+                                  the same targets) each time recalibrate_every hard locations are added
+        :return: the new radius and the mean number of hard locations it is estimated to activate
+        """
+        if (target_activations is None) == (target_fraction is None):
+            raise Exception('Set either target_activations or target_fraction to calibrate the radius')
+        slots = self.store.get_slots()
+        if len(slots) == 0:
+            raise Exception('There are no hard locations to calibrate the radius')
+        sampled = self.rng.choice(slots, min(samples, len(slots)), replace=False)
+        if probe_addresses is not None:
+            rows = [self.encode_address(address) for address in probe_addresses]
+        elif self.hard_locations_creation == HardLocationCreation.OnDemand:
+            rows = self.store.addresses[self.rng.choice(slots, min(probes, len(slots)), replace=False)]
+        else:
+            rows = self.create_random_addresses(probes)
+        distances = self.get_row_distances(rows, sampled)
+        self.count('distance_evaluations', distances.size)
+
+        # mean number of hard locations activated by each radius, scaled from the sample to the whole store
+        histogram   = np.bincount(distances.ravel())
+        activations = np.cumsum(histogram) / len(rows) * len(slots) / len(sampled)
+        target      = target_activations if target_activations is not None else target_fraction * len(slots)
+        radius      = int(min(np.searchsorted(activations, target), len(activations) - 1))
+        self.radius = radius
+        if self.read_cache is not None:
+            self.read_cache.clear()
+        self.calibration = {'target_activations': target_activations,
+                            'target_fraction':    target_fraction,
+                            'samples':            samples,
+                            'probes':             probes,
+                            'recalibrate_every':  recalibrate_every,
+                            'size':               len(slots)}
+        self.count('calibrations')
+        return radius, float(activations[radius])
+
+    def recalibrate_radius(self):
+        """
+        Calibrates the radius again if it was calibrated with recalibrate_every and enough hard locations were added
+        since then
+        :return:
+        """
+        calibration = self.calibration
+        if calibration is None or not calibration['recalibrate_every'] or \
+                len(self.store) < calibration['size'] + calibration['recalibrate_every']:
+            return
+        self.calibrate_radius(target_activations=calibration['target_activations'],
+                              target_fraction=calibration['target_fraction'], samples=calibration['samples'],
+                              probes=calibration['probes'], recalibrate_every=calibration['recalibrate_every'])
+
+    def get_row_distances(self, rows, indexes):
+        """
+        Returns a (len(rows), len(indexes)) matrix with the distance between each address (encoded as the store
+        keeps them) and each hard location in indexes
+        :param rows:
+        :param indexes: slots
+        :return:
+        """
+        return np.array([[row.distance(self.store.addresses[slot]) for slot in indexes] for row in rows],
+                        dtype=np.int64).reshape(len(rows), len(indexes))
+
+    def get_value_from_sums(self, sums, total):
+        if self.array_values:
+            if total == 0:
+                return self.content_class.get_null_array(self.content_length)
+            return self.content_class.get_array_from_counters(sums / total)
+        if total == 0:
             # no content associated with this address, return null value
-            # print(self.content_class.address_length)
-            content = self.content_class.get_null_value(self.content_length)
-        return content
+            return self.content_class.get_null_value(self.content_length)
+        return self.content_class.get_value_from_counters(sums / total)
+
+    def write_many(self, addresses, contents, chunk_size=None):
+        """
+        Writes each content in its address, same result as calling write for each pair in order
+        :param addresses: list (or 2-D array) of addresses
+        :param contents:  list (or 2-D array) of contents, one per address
+        :param chunk_size: max number of addresses processed at once (default self.chunk_size)
+        :return:
+        """
+        for address, content in zip(addresses, contents):
+            self.write(address, content)
+
+    def fit_stream(self, source, batch_size=default_chunk_size, progress=None, progress_every=10):
+        """
+        Writes all the (address, content) pairs of source in batches of batch_size (see write_many), only one batch
+        is kept in memory so any dataset size can be streamed
+        :param source: iterable (ex: a generator) of (address, content) pairs, or the path of a file: .jsonl with one
+                       {"address": ..., "content": ...} per line, or .npy (memory mapped) with one address followed
+                       by its content per row
+        :param batch_size:
+        :param progress: optional function(report) called every progress_every batches and at the end, report is
+                         a dictionary as the one returned
+        :param progress_every:
+        :return: pairs and batches written, seconds and pairs per second
+        """
+        start  = time.perf_counter()
+        report = {'pairs': 0, 'batches': 0, 'seconds': 0.0, 'pairs_per_sec': 0.0}
+        for addresses, contents in get_stream_batches(source, batch_size, self.address_length):
+            self.write_many(*self.prepare_batch(addresses, contents), chunk_size=batch_size)
+            report['pairs']        += len(addresses)
+            report['batches']      += 1
+            report['seconds']       = time.perf_counter() - start
+            report['pairs_per_sec'] = report['pairs'] / report['seconds'] if report['seconds'] > 0 else 0.0
+            if progress is not None and report['batches'] % progress_every == 0:
+                progress(dict(report))
+        if progress is not None and report['batches'] % progress_every != 0:
+            progress(dict(report))
+        return report
+
+    def prepare_batch(self, addresses, contents):
+        """
+        Returns a batch of addresses and contents read by fit_stream in the format expected by write_many: rows of
+        arrays are converted to binary strings or lists of integers
+        :param addresses: list or 2-D array
+        :param contents: list or 2-D array
+        :return:
+        """
+        if isinstance(addresses, np.ndarray):
+            addresses = [decode_values(row, self.address_class) for row in addresses]
+        if isinstance(contents, np.ndarray):
+            contents = [decode_values(row, self.content_class) for row in contents]
+        return addresses, contents
+
+    def read_many(self, addresses, chunk_size=None):
+        """
+        Returns the content of each address, same result as calling read for each one
+        :param addresses: list (or 2-D array) of addresses
+        :param chunk_size: max number of addresses processed at once (default self.chunk_size)
+        :return:
+        """
+        return self.get_values_from_sums(*self.read_many_sums(addresses, chunk_size=chunk_size))
+
+    def get_values_from_sums(self, sums, totals):
+        """
+        Returns the contents read from the sums of the counters of many addresses and how many hard locations were
+        added in each one (see read_many_sums): a 2-D array with array_values, a list of values otherwise
+        :param sums:
+        :param totals:
+        :return:
+        """
+        if self.array_values:
+            # all the contents at once, addresses without near hard locations read the null value
+            values = self.content_class.get_array_from_counters(sums / np.maximum(totals, 1)[:, np.newaxis])
+            values[totals == 0] = self.content_class.get_null_array(self.content_length)
+            return values
+        return [self.get_value_from_sums(counter, total) for counter, total in zip(sums, totals)]
+
+    def read_iterative(self, addresses, max_iters=10, tol=0, chunk_size=None):
+        """
+        Reads each address feeding the content read back as the next address until it converges (the content is
+        within tol of the address it was read from) or max_iters reads are done. All the queries are read as one
+        batch (read_many) and the converged ones are masked out of the next iterations
+        :param addresses: list of addresses (content_length must be address_length)
+        :param max_iters: maximum number of reads of each query
+        :param tol: maximum distance between an address and its content to consider the query converged
+        :param chunk_size: see read_many
+        :return: the last content read for each address and the number of iterations of each query
+        """
+        if self.address_length != self.content_length:
+            raise Exception('Iterative reads need content_length (%s) equal to address_length (%s)' %
+                            (self.content_length, self.address_length))
+        values     = list(addresses)
+        iterations = np.zeros(len(values), dtype=np.int64)
+        active     = np.arange(len(values))
+        for _ in range(max_iters):
+            if len(active) == 0:
+                break
+            # with array_values the contents read are NumPy rows, fed back as one 2-D array
+            previous = stack_rows([values[i] for i in active])
+            contents = self.read_many(previous, chunk_size=chunk_size)
+            for i, content in zip(active, contents):
+                values[i] = content
+            iterations[active] += 1
+            active = active[self.get_pair_distances(previous, contents) > tol]
+        return values, iterations
+
+    def get_pair_distances(self, addresses1, addresses2):
+        """
+        Returns the distance between each address of addresses1 and the one in the same position of addresses2
+        :param addresses1:
+        :param addresses2:
+        :return:
+        """
+        return np.array([self.encode_address(address1).distance(self.encode_address(address2))
+                         for address1, address2 in zip(addresses1, addresses2)], dtype=np.int64)
+
+    def read_many_sums(self, addresses, chunk_size=None):
+        """
+        Same as read_sums for many addresses
+        :param addresses:
+        :param chunk_size:
+        :return: a (len(addresses), content_length) matrix of sums and a vector with the totals
+        """
+        all_sums = [self.read_sums(address) for address in addresses]
+        sums     = np.array([counter for counter, _ in all_sums], dtype=float).reshape(-1, self.content_length)
+        return sums, np.array([total for _, total in all_sums], dtype=np.int64)
 
     def initialize_hard_location(self, debug=False):
-        if self.hard_locations_creation == HardLocationCreation.Nothing:
-            hard_locations = []
-        elif self.hard_locations_creation == HardLocationCreation.Random:
-            hard_locations = self.create_random_hard_locations(debug=debug)
-        elif self.hard_locations_creation == HardLocationCreation.Uniform:
-            hard_locations = create_uniform_hard_locations(self.number_of_hard_locations, self.max_possible_values,
-                                                           self.address_length, self.content_length, debug=debug)
-        elif self.hard_locations_creation == HardLocationCreation.OnDemand:
+        """
+        Adds the hard locations to the store according to hard_locations_creation: random addresses or a uniform
+        lattice over the address space. They are generated in chunks of vectors of digits (no address is built as
+        a number), so any address length works
+        :param debug:
+        :return:
+        """
+        if self.hard_locations_creation in [HardLocationCreation.Nothing, HardLocationCreation.OnDemand]:
             # do nothing on creation time
-            hard_locations = []
-        else:
+            return
+        if self.hard_locations_creation not in [HardLocationCreation.Random, HardLocationCreation.Uniform]:
             raise Exception('%s for hard locations initialization is not implemented yet' %
                             self.hard_locations_creation)
-        return hard_locations
-
-    def create_random_hard_locations(self, debug=False):
         if debug:
-            print('create %s random locations' % self.number_of_hard_locations)
-        hard_locations = []
-        for i in range(self.number_of_hard_locations):
-            address = self.create_random_address()
-            hard_locations.append(create_hard_location(address, self.content_length))
-            if debug:
-                print('   i:%s address:%s' % (i, address))
-        return hard_locations
+            print('create %s %s hard locations' % (self.number_of_hard_locations,
+                                                   HardLocationCreation(self.hard_locations_creation).name))
+        step = self.max_possible_values // max(1, self.number_of_hard_locations)
+        for start, end in get_chunks(self.number_of_hard_locations, initialization_chunk_size):
+            if self.hard_locations_creation == HardLocationCreation.Random:
+                addresses = self.create_random_addresses(end - start)
+            else:
+                addresses = self.create_lattice_addresses(start, end - start, step)
+            self.store.add_many(addresses)
+
+    def create_random_addresses(self, n):
+        """
+        Returns n random addresses encoded as the store keeps them
+        :param n:
+        :return:
+        """
+        return self.encode_digits(create_random_digits(n, self.address_length, self.values_per_dimensions, self.rng))
+
+    def create_lattice_addresses(self, first, n, step):
+        """
+        Returns the addresses (encoded as the store keeps them) of the numbers first * step, ... (n of them) of the
+        address space
+        :param first:
+        :param n:
+        :param step:
+        :return:
+        """
+        return self.encode_digits(create_lattice_digits(first, n, step, self.values_per_dimensions,
+                                                        self.address_length))
+
+    def encode_digits(self, digits):
+        """
+        Returns the addresses with the given digits (one row per address) encoded as the store keeps them
+        :param digits:
+        :return:
+        """
+        addresses    = np.empty(len(digits), dtype=object)
+        addresses[:] = [self.address_class.create_from_digits(row) for row in digits]
+        return addresses
 
     def create_random_address(self):
-        j = rn.randint(0, self.max_possible_values)
-        return self.address_class.create_address_from_number(j)
+        digits = create_random_digits(1, self.address_length, self.values_per_dimensions, self.rng)
+        return self.address_class.create_from_digits(digits[0])
 
-    def create_hard_locations_on_demand(self, address, content, near_hard_locations, near_distance=3):
+    @instrumented('create_hard_locations_on_demand')
+    def create_hard_locations_on_demand(self, address, content, near_indexes, near_distance=3):
         """
         Applies the Dynamic Allocation algorithm as defined in
            https://link.springer.com/content/pdf/10.1007/978-3-540-30115-8_33.pdf
+        the near hard locations learn the content and new ones are created (near address) until there are
+        min_near_hard_locations
         :param near_distance:
         :param address: :type Address
         :param content:
-        :param near_hard_locations:
-        :return:
-        """
-        address_obj        = self.address_class(address)
-        new_hard_locations = [address_obj] if len(near_hard_locations) == 0 else near_hard_locations
-        new_n              = len(new_hard_locations)
-        if new_n < self.min_near_hard_locations:
-            # complement with randomly near locations
-            for _ in range(self.min_near_hard_locations - new_n):
-                new_hard_locations.append(address_obj.get_random_near_address(near_distance))
-
-        # delete hard locations if maximum in reached
-        tries = 0
-        while len(self.hard_locations) >= self.number_of_hard_locations:
-            to_delete_i = rn.randint(0, len(self.number_of_hard_locations)-1)
-            to_delete_hard_location = self.hard_locations[to_delete_i]
-            if to_delete_hard_location[0] in new_hard_locations:
-                # do not delete the active ones
-                tries += 1
-                if tries > 1000:
-                    raise Exception('too much tries deleting hard locations')
-                continue
-            del self.hard_locations[to_delete_i]
+        :param near_indexes: slots of the hard locations already near address
+        :return:
+        """
+        copies = 1 if len(near_indexes) == 0 else 0
+        near_n = max(0, self.min_near_hard_locations - len(near_indexes) - copies)
+        digits = np.repeat(self.address_class.get_digits(address)[np.newaxis, :], copies + near_n, axis=0)
+        # complement with randomly near locations, all generated at once
+        digits[copies:] = self.address_class.create_near_digits(digits[copies:],
+                                                                self.get_near_distances(near_n, near_distance),
+                                                                self.rng)
+        new_addresses = self.encode_digits(digits)
+        self.update_counters(near_indexes, content)
+
+        # delete hard locations if maximum in reached (never the near ones)
+        to_delete_n = len(self.store) + len(new_addresses) - self.number_of_hard_locations
+        if to_delete_n > 0:
+            evicted = self.eviction.select(self.store, to_delete_n, near_indexes)
+            for slot in evicted:
+                self.store.remove(slot)
+            self.count('evicted', len(evicted))
+
+        # store content in each of the new addresses
+        new_slots = self.store.add_many(new_addresses) if len(new_addresses) else np.zeros(0, dtype=np.int64)
+        self.count('allocated', len(new_slots))
+        self.update_counters(new_slots, content)
+        self.recalibrate_radius()
+
+    def get_near_distances(self, n, near_distance):
+        """
+        Returns the distances of n new hard locations created on demand to the address written: uniform in
+        [1, near_distance], override to use another distribution
+        :param n:
+        :param near_distance:
+        :return:
+        """
+        return self.rng.integers(min(1, near_distance), near_distance + 1, n)
+
+    def update_counters(self, indexes, content):
+        """
+        Updates the counters of all the hard locations in indexes with content
+        :param indexes: slots
+        :param content:
+        :return:
+        """
+        for slot in indexes:
+            self.update_hard_location_counters((self.store.addresses[slot], self.store.counters[slot]), content)
+        self.store.updated(indexes)
+
+    def update_hard_location_counters(self, hard_location, content):
+        counters    = hard_location[1]
+        increments  = [self.content_class.get_value_to_increment_counter(value) for value in content]
+        counters[:] = saturate(counters + np.array(increments, dtype=get_accumulator_type(counters.dtype)),
+                               counters.dtype)
+
+    def get_distances(self, address, indexes):
+        """
+        Returns the distance between address and each hard location in indexes
+        :param address:
+        :param indexes: slots
+        :return:
+        """
+        address_obj = self.encode_address(address)
+        return np.array([address_obj.distance(self.store.addresses[slot]) for slot in indexes], dtype=np.int64)
+
+    @instrumented('get_hard_locations_in_distance')
+    def get_near_indexes(self, address, distance):
+        """
+        Returns the slots of the hard locations that are near address
+        :param address:
+        :param distance: distance to be considered near
+        :return:
+        """
+        return self.find_near_indexes(address, distance)
+
+    def find_near_indexes(self, address, distance):
+        """
+        Search of get_near_indexes, engines override it with their own scan
+        :param address:
+        :param distance:
+        :return:
+        """
+        use_index  = self.index is not None and self.use_index
+        candidates = self.index.search(self.encode_address(address), distance) if use_index else None
+        if candidates is None:
+            # no index (or it can not answer for this distance): linear scan
+            candidates = self.store.get_slots()
+        self.count('distance_evaluations', len(candidates))
+        return candidates[self.get_distances(address, candidates) <= distance]
+
+    def get_hard_locations_in_distance(self, address, distance):
+        """
+        Returns the list of hard location that are near address
+        :param address:
+        :param distance: distance to be considered near
+        :return:
+        """
+        return [(self.decode_address(self.store.addresses[slot]), self.store.counters[slot])
+                for slot in self.get_near_indexes(address, distance)]
+
+    def save(self, path):
+        """
+        Saves the SDM in directory path: the addresses and counters of the hard locations as .npy files and the
+        parameters needed to create it again in a yaml header
+        :param path:
+        :return:
+        """
+        os.makedirs(path, exist_ok=True)
+        slots     = self.store.get_slots()
+        addresses = self.store.addresses[slots]
+        if self.address_dtype == object:
+            addresses = np.array([address.value for address in addresses])
+        np.save(os.path.join(path, k_addresses_file), addresses)
+        np.save(os.path.join(path, k_counters_file), self.store.counters[slots])
+        header = {'class': type(self).__name__, 'parameters': self.get_parameters()}
+        yf.save_yaml_file(header, k_header_file, directory=path)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        Returns the SDM saved in directory path
+        :param path:
+        :param mmap: if True addresses and counters are memory mapped (read only) instead of loaded, so many
+                     processes can share the same pages. Use False to keep writing in the SDM
+        :return:
+        """
+        header    = yf.get_yaml_file(k_header_file, directory=path)
+        sdm       = SDM.create_from_parameters(header['class'], header['parameters'])
+        mmap_mode = 'r' if mmap else None
+        addresses = np.load(os.path.join(path, k_addresses_file), mmap_mode=mmap_mode)
+        counters  = np.load(os.path.join(path, k_counters_file), mmap_mode=mmap_mode)
+        if sdm.address_dtype == object:
+            objects = np.empty(len(addresses), dtype=object)
+            objects[:] = [sdm.address_class(address.tolist()) for address in addresses]
+            addresses  = objects
+        sdm.store.set_arrays(addresses, counters)
+        return sdm
+
+    @staticmethod
+    def create_from_parameters(class_name, parameters):
+        """
+        Returns an SDM of class_name created with parameters (as returned by get_parameters) but without any hard
+        location, they are expected to be set later (ex: with store.set_arrays)
+        :param class_name:
+        :param parameters:
+        :return:
+        """
+        sdm_class = globals()[class_name]
+        accepted  = inspect.signature(sdm_class.__init__).parameters
+        kwargs    = {name: value for name, value in parameters.items() if name in accepted}
+        kwargs['hard_location_creation'] = HardLocationCreation.Nothing
+        sdm = sdm_class(**kwargs)
+        sdm.hard_locations_creation = HardLocationCreation(parameters['hard_location_creation'])
+        sdm.min_near_hard_locations = parameters['min_near_hard_locations']
+        sdm.set_read_mode(parameters.get('read_mode', ReadMode.Radius), parameters.get('read_k'))
+        return sdm
+
+    def get_parameters(self):
+        """
+        Returns the parameters used to create this SDM (only the ones accepted by its class are used by load)
+        :return:
+        """
+        parameters = {'address_length':           self.address_length,
+                      'content_length':           self.content_length,
+                      'number_of_hard_locations': self.number_of_hard_locations,
+                      'radius':                   self.radius,
+                      'values_per_dimension':     self.values_per_dimensions,
+                      'hard_location_creation':   int(self.hard_locations_creation),
+                      'min_near_hard_locations':  self.min_near_hard_locations,
+                      'eviction_policy':          int(self.eviction.policy),
+                      'counter_type':             self.store.counters.dtype.name,
+                      'multi_index':              isinstance(self.index, MultiIndexHashing),
+                      'metric_index':             isinstance(self.index, PivotIndex),
+                      'n_threads':                self.n_threads,
+                      'read_cache_size':          self.read_cache.size if self.read_cache is not None else None,
+                      'seed':                     self.seed,
+                      'read_mode':                int(self.read_mode),
+                      'read_k':                   self.read_k,
+                      'float_content':            bool(getattr(self, 'float_content', False)),
+                      'array_values':             self.array_values}
+        if hasattr(self, 'learning_rate'):
+            parameters['learning_rate'] = float(self.learning_rate)
+        return parameters
+
+    def get_memory_footprint(self):
+        """
+        Returns the bytes used by the hard locations (for all the preallocated slots): addresses, counters and per
+        slot bookkeeping (occupied mask, versions and eviction metadata). Addresses kept as objects only count the
+        references
+        :return:
+        """
+        store     = self.store
+        eviction  = self.eviction
+        footprint = {'addresses':   store.addresses.nbytes,
+                     'counters':    store.counters.nbytes,
+                     'bookkeeping': store.occupied.nbytes + store.versions.nbytes + eviction.last_access.nbytes +
+                                    eviction.access_count.nbytes + eviction.versions.nbytes}
+        footprint['total']             = sum(footprint.values())
+        footprint['per_hard_location'] = footprint['total'] / max(1, store.capacity())
+        footprint['counter_type']      = store.counters.dtype.name
+        return footprint
+
+    def print_hard_locations(self, title='Hard Locations'):
+        print(title)
+        for hard_location in self.hard_locations:
+            print('   %s -> %s' % (hard_location[0], hard_location[1]))
+
+
+class BinarySDM(SDM):
+    """
+    Address and Content is binary
+    """
+
+    def __init__(self, address_length, content_length, number_of_hard_locations, radius,
+                 hard_location_creation=HardLocationCreation.Nothing, eviction_policy=EvictionPolicy.Random,
+                 counter_type=int, read_cache_size=None, array_values=False, seed=None, debug=False):
+        super().__init__(address_length, content_length, number_of_hard_locations, radius, values_per_dimension=2,
+                         hard_location_creation=hard_location_creation, address_class=BinaryAddress,
+                         content_class=BinaryAddress, counter_type=counter_type, eviction_policy=eviction_policy,
+                         read_cache_size=read_cache_size, array_values=array_values, seed=seed, debug=debug)
+
+
+class ArithmeticSDM(SDM):
+    """
+    Address and Content are list of Integers as defined in
+       https://www.iaeng.org/IJCS/issues_v39/issue_4/IJCS_39_4_03.pdf
+    """
+
+    def __init__(self, address_length, content_length, number_of_hard_locations, radius, learning_rate=1.0,
+                 values_per_dimension=255, hard_location_creation=HardLocationCreation.Nothing,
+                 eviction_policy=EvictionPolicy.Random, counter_type=int, read_cache_size=None, array_values=False,
+                 seed=None, debug=False):
+        self.learning_rate = learning_rate
+        super().__init__(address_length, content_length, number_of_hard_locations, radius,
+                         values_per_dimension=values_per_dimension, hard_location_creation=hard_location_creation,
+                         address_class=IntegersAddress, content_class=IntegersAddress, counter_type=counter_type,
+                         eviction_policy=eviction_policy, read_cache_size=read_cache_size,
+                         array_values=array_values, seed=seed, debug=debug)
+
+    def update_hard_location_counters(self, hard_location, content):
+        counters    = hard_location[1]
+        increments  = np.array([self.content_class.get_value_to_increment_counter(value) for value in content],
+                               dtype=float)
+        counters[:] = saturate(counters + self.learning_rate * (increments - counters), counters.dtype)
+
+
+class ArraySDM(SDM):
+    """
+    Storage engine that keeps the addresses as numeric rows of the store instead of Address objects, so distances
+    and counter updates are computed for all hard locations at once.
+    Subclasses define how an address is encoded in a row and how distances are computed
+    """
+    address_dtype = np.uint8
+    float_content = False
+
+    def get_address_width(self, address_length):
+        return address_length
+
+    def encode_address(self, address):
+        """
+        Returns address (a raw value or an Address) as a row of the addresses matrix, by default its digits
+        :param address:
+        :return:
+        """
+        value = address.value if isinstance(address, Address) else address
+        return np.asarray(value, dtype=self.address_dtype).ravel()
+
+    def decode_address(self, row):
+        """
+        Returns an Address from a row of the addresses matrix
+        :param row:
+        :return:
+        """
+        return self.address_class.create_from_digits(row)
+
+    def encode_digits(self, digits):
+        return digits.astype(self.address_dtype)
+
+    def get_increments(self, content):
+        """
+        Returns content as a vector to be applied to the counters
+        :param content:
+        :return:
+        """
+        return np.array([self.content_class.get_value_to_increment_counter(value) for value in content])
+
+    @staticmethod
+    def get_float_increments(content):
+        """
+        Returns a real valued content as a float32 vector to be applied to the counters (float_content)
+        :param content:
+        :return:
+        """
+        value = content.value if isinstance(content, Address) else content
+        return np.asarray(value, dtype=np.float32).ravel()
+
+    def get_distances(self, address, indexes=None):
+        """
+        Returns the distance between address and every slot ever used (or only the ones in indexes), subclasses
+        define the metric
+        :param address:
+        :param indexes:
+        :return:
+        """
+        return np.zeros(self.store.end if indexes is None else len(self.addresses[indexes]), dtype=np.int64)
+
+    def find_near_indexes(self, address, distance):
+        if self.uses_index(address):
+            return super().find_near_indexes(address, distance)
+        self.count('distance_evaluations', self.store.end)
+        if self.executor is not None:
+            blocks = self.map_blocks(lambda block: self.get_block_near_indexes(address, distance, block))
+            return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int64)
+        # one pass over all the slots, free ones are masked out
+        return np.flatnonzero((self.get_distances(address) <= distance) & self.store.occupied[:self.store.end])
+
+    def get_block_near_indexes(self, address, distance, block):
+        """
+        Returns the slots in block (a slice of the store) of the hard locations that are near address
+        :param address:
+        :param distance:
+        :param block:
+        :return:
+        """
+        near = (self.get_distances(address, block) <= distance) & self.store.occupied[block]
+        return block.start + np.flatnonzero(near)
+
+    def get_near_sums(self, address):
+        if self.float_content and self.executor is None:
+            # activation vector times the counters matrix (one BLAS matrix-vector product)
+            near_indexes             = self.get_read_indexes(address)
+            activation               = np.zeros(self.store.end, dtype=self.counters.dtype)
+            activation[near_indexes] = 1
+            return near_indexes, activation @ self.counters
+        if self.executor is None or self.uses_index(address) or self.read_mode != ReadMode.Radius:
+            return super().get_near_sums(address)
+
+        def get_block_sums(block):
+            near_indexes = self.get_block_near_indexes(address, self.radius, block)
+            return near_indexes, self.counters[near_indexes].sum(axis=0)
+
+        self.count('distance_evaluations', self.store.end)
+        sums         = np.zeros(self.content_length, dtype=get_accumulator_type(self.counters.dtype))
+        near_indexes = []
+        # partial sums are added in block order, so the result does not depend on which thread finished first
+        for block_indexes, block_sums in self.map_blocks(get_block_sums):
+            sums += block_sums
+            near_indexes.append(block_indexes)
+        near_indexes = np.concatenate(near_indexes) if near_indexes else np.zeros(0, dtype=np.int64)
+        return near_indexes, sums
+
+    def map_blocks(self, function):
+        """
+        Returns the results of function for each block (slice) of block_size slots, in block order. The blocks
+        are computed by the thread pool
+        :param function:
+        :return:
+        """
+        blocks = [slice(start, end) for start, end in get_chunks(self.store.end, self.block_size)]
+        return list(self.executor.map(function, blocks))
+
+    def uses_index(self, address):
+        return self.index is not None and self.use_index and not self.is_partial_address(address)
+
+    def is_partial_address(self, address):
+        """
+        Returns True if address is shorter than address_length (so only its first values are compared)
+        :param address:
+        :return:
+        """
+        return False
+
+    def prepare_batch(self, addresses, contents):
+        if self.hard_locations_creation == HardLocationCreation.OnDemand:
+            # written one by one through Address objects
+            return super().prepare_batch(addresses, contents)
+        # rows of arrays are used directly by the vectorized write_many
+        return addresses, contents
+
+    def write_many(self, addresses, contents, chunk_size=None):
+        if self.hard_locations_creation == HardLocationCreation.OnDemand:
+            # each write can create (or delete) hard locations, so the next activations depend on it
+            super().write_many(addresses, contents)
+            return
+        for start, end in get_chunks(len(addresses), self.get_chunk_size(chunk_size)):
+            activations = self.get_activation_matrix(addresses[start:end])
+            increments  = np.array([self.get_increments(content) for content in contents[start:end]])
+            self.apply_writes(activations, increments)
+            self.store.updated(np.flatnonzero(activations.any(axis=0)))
+            self.touch_many(activations, written=True)
+
+    def read_many_sums(self, addresses, chunk_size=None):
+        if self.read_mode == ReadMode.Sampled:
+            return super().read_many_sums(addresses, chunk_size)
+        sums   = np.zeros((len(addresses), self.content_length), dtype=float)
+        totals = np.zeros(len(addresses), dtype=np.int64)
+        for start, end in get_chunks(len(addresses), self.get_chunk_size(chunk_size)):
+            if self.read_mode == ReadMode.KNearest:
+                activations = self.get_nearest_activation_matrix(addresses[start:end], self.read_k)
+            else:
+                activations = self.get_activation_matrix(addresses[start:end])
+            # float counters are multiplied in their own type (a single float32 GEMM with float_content)
+            counter_type = self.counters.dtype if np.issubdtype(self.counters.dtype, np.floating) else float
+            activations  = activations.astype(counter_type)
+            self.touch_many(activations)
+            totals[start:end] = activations.sum(axis=1)
+            sums[start:end]   = activations @ self.counters
+        return sums, totals
+
+    def get_nearest_indexes(self, address, k):
+        occupied = self.store.occupied[:self.store.end]
+        if np.count_nonzero(occupied) <= k:
+            return np.flatnonzero(occupied)
+        self.count('distance_evaluations', self.store.end)
+        distances = self.get_distances(address)
+        distances = np.where(occupied, distances, distances.max() + 1)
+        return np.sort(get_smallest_positions(distances, k))
+
+    def get_nearest_activation_matrix(self, addresses, k):
+        """
+        Returns a (len(addresses), slots) boolean matrix, True for the k hard locations nearest to each address
+        :param addresses:
+        :param k:
+        :return:
+        """
+        self.count('distance_evaluations', len(addresses) * self.store.end)
+        occupied    = self.store.occupied[:self.store.end]
+        distances   = self.get_distance_matrix(addresses)
+        activations = np.zeros(distances.shape, dtype=bool)
+        k           = min(k, distances.shape[1])
+        if k > 0:
+            distances = np.where(occupied, distances, distances.max() + 1)
+            np.put_along_axis(activations, get_smallest_positions(distances, k), True, axis=1)
+        return activations & occupied
+
+    def get_chunk_size(self, chunk_size, columns=None):
+        """
+        Returns the number of addresses processed at once by write_many/read_many: chunk_size (default
+        self.chunk_size) but no more than the ones whose arrays against all the hard locations (or columns of them)
+        fit in memory_budget
+        :param chunk_size:
+        :param columns: number of hard locations each address is compared with (default all the slots ever used)
+        :return:
+        """
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        columns    = self.store.end if columns is None else columns
+        return int(max(1, min(chunk_size, self.memory_budget // (self.get_pair_bytes() * max(1, columns)))))
+
+    def get_row_distances(self, rows, indexes):
+        # computed for chunks of rows whose arrays against indexes fit in memory_budget
+        rows      = np.asarray(rows, dtype=self.address_dtype).reshape(len(rows), -1)
+        distances = np.zeros((len(rows), len(indexes)), dtype=np.int64)
+        for start, end in get_chunks(len(rows), self.get_chunk_size(len(rows), len(indexes))):
+            distances[start:end] = self.get_row_chunk_distances(rows[start:end], indexes)
+        return distances
+
+    def get_row_chunk_distances(self, rows, indexes):
+        """
+        Returns a (len(rows), len(indexes)) matrix with the distance between each encoded row and each hard location
+        in indexes, subclasses define the metric
+        :param rows: 2-D array of encoded addresses
+        :param indexes: slots
+        :return:
+        """
+        return np.zeros((len(rows), len(indexes)), dtype=np.int64)
+
+    def get_pair_bytes(self):
+        """
+        Returns the bytes used for each (address, hard location) pair of a chunk: distance, activations as bool and
+        float, and for KNearest the masked distances and their order (8 + 1 + 8 + 8 + 8) plus what the distance
+        kernel needs
+        :return:
+        """
+        return 33 + 8
 
-        # store content in each of the new addresses
-        for new_address in new_hard_locations:
-            hard_location = create_hard_location(new_address, self.content_length)
-            self.update_hard_location_counters(hard_location, content)
-            self.hard_locations.append(hard_location)
+    def get_distance_matrix(self, addresses, indexes=None):
+        """
+        Returns a (len(addresses), number of hard locations) matrix with the distance between each address and
+        each hard location (or only the ones in indexes)
+        :param addresses:
+        :param indexes:
+        :return:
+        """
+        stored = self.addresses if indexes is None else self.addresses[indexes]
+        return np.array([self.get_distances(address, indexes) for address in addresses]).reshape(-1, len(stored))
 
-    def update_hard_location_counters(self, hard_location, content):
-        for i, value in enumerate(content):
-            hard_location[1][i] += self.content_class.get_value_to_increment_counter(value)
+    def get_read_changes(self, addresses, slots):
+        if self.read_mode == ReadMode.KNearest:
+            return np.ones(len(addresses), dtype=bool)
+        return (self.get_distance_matrix(addresses, slots) <= self.radius).any(axis=1)
 
-    def get_hard_locations_in_distance(self, address, distance):
+    def touch_many(self, activations, written=False):
+        counts = activations.sum(axis=0).astype(np.int64)
+        slots  = np.flatnonzero(counts)
+        self.eviction.touch(self.store, slots, counts[slots], written=written)
+
+    def get_activation_matrix(self, addresses):
         """
-        Returns the list of hard location that are near address
-        :param address:
-        :param distance: distance to be considered near
+        Returns a (len(addresses), slots) boolean matrix, True where the hard location is near the address
+        :param addresses:
         :return:
         """
-        address_obj      = self.address_class(address)
-        hard_in_distance = [hard_location for hard_location in self.hard_locations
-                            if address_obj.distance(hard_location[0]) <= distance]
-        return hard_in_distance
-
-    def print_hard_locations(self, title='Hard Locations'):
-        print(title)
-        for hard_location in self.hard_locations:
-            print('   %s -> %s' % (hard_location[0], hard_location[1]))
+        self.count('distance_evaluations', len(addresses) * self.store.end)
+        if self.executor is not None:
+            blocks = self.map_blocks(lambda block: (self.get_distance_matrix(addresses, block) <= self.radius) &
+                                     self.store.occupied[block])
+            return np.concatenate(blocks, axis=1) if blocks else np.zeros((len(addresses), 0), dtype=bool)
+        return (self.get_distance_matrix(addresses) <= self.radius) & self.store.occupied[:self.store.end]
+
+    def apply_writes(self, activations, increments):
+        """
+        Updates all counters with a chunk of writes
+        :param activations: (writes, hard locations) boolean matrix, True if the hard location is near the address
+        :param increments:  (writes, content_length) matrix, one row per content
+        :return:
+        """
+        counters = self.counters
+        if self.float_content:
+            # one GEMM in the type of the counters, added in place
+            counters += activations.T.astype(counters.dtype) @ increments.astype(counters.dtype)
+            return
+        accumulator = get_accumulator_type(counters.dtype)
+        counters[:] = saturate(counters + activations.T.astype(accumulator) @ increments.astype(accumulator),
+                               counters.dtype)
+
+    def update_counters(self, indexes, content):
+        """
+        Updates the counters of all the hard locations in indexes with content
+        :param indexes:
+        :param content:
+        :return:
+        """
+        counters               = self.counters[indexes].astype(get_accumulator_type(self.counters.dtype))
+        self.counters[indexes] = saturate(counters + self.get_increments(content), self.counters.dtype)
+        self.store.updated(indexes)
 
 
-class BinarySDM(SDM):
+class PackedBinarySDM(ArraySDM):
     """
-    Address and Content is binary
+    Same as BinarySDM but addresses are packed 8 bits per byte in one uint8 matrix, the Hamming distance to all
+    hard locations is computed in one XOR + popcount pass
     """
 
     def __init__(self, address_length, content_length, number_of_hard_locations, radius,
-                 hard_location_creation=HardLocationCreation.Nothing, debug=False):
+                 hard_location_creation=HardLocationCreation.Nothing, multi_index=False,
+                 eviction_policy=EvictionPolicy.Random, counter_type=int, n_threads=None, read_cache_size=None,
+                 float_content=False, array_values=False, seed=None, debug=False):
+        """
+        :param multi_index: if True keeps a MultiIndexHashing index so reads only check a few hard locations
+        :param float_content: if True contents are real vectors (RealAddress) added to float32 counters (unless
+                              counter_type is another float type) and reads return their mean
+        """
+        index = MultiIndexHashing(address_length, radius) if multi_index else None
+        self.float_content = float_content
         super().__init__(address_length, content_length, number_of_hard_locations, radius, values_per_dimension=2,
                          hard_location_creation=hard_location_creation, address_class=BinaryAddress,
-                         content_class=BinaryAddress, debug=debug)
-
-
-class ArithmeticSDM(SDM):
+                         content_class=RealAddress if float_content else BinaryAddress,
+                         counter_type=get_content_counter_type(counter_type, float_content), index=index,
+                         eviction_policy=eviction_policy, n_threads=n_threads, read_cache_size=read_cache_size,
+                         array_values=array_values, seed=seed, debug=debug)
+
+    def get_address_width(self, address_length):
+        return (address_length + 7) // 8
+
+    def encode_address(self, address):
+        if isinstance(address, np.ndarray):
+            # one 0/1 value per bit
+            return np.packbits(address.astype(np.uint8))
+        return pack_binary_address(str(address), self.address_length)
+
+    def decode_address(self, row):
+        return BinaryAddress(unpack_binary_address(row, self.address_length))
+
+    def encode_digits(self, digits):
+        return np.packbits(digits.astype(np.uint8), axis=1).reshape(len(digits), -1)
+
+    def create_lattice_addresses(self, first, n, step):
+        # the packed row of a number is its bytes once shifted over the padding bits, so the lattice is computed
+        # directly in base 256
+        width = self.get_address_width(self.address_length)
+        return create_lattice_digits(first, n, step << (8 * width - self.address_length), 256, width)
+
+    def create_random_addresses(self, n):
+        # random bytes straight into the packed matrix, the padding bits of the last byte are cleared
+        packed = self.rng.integers(0, 256, (n, self.get_address_width(self.address_length)), dtype=np.uint8)
+        return packed & pack_binary_address('1' * self.address_length, self.address_length)
+
+    def get_increments(self, content):
+        if self.float_content:
+            return self.get_float_increments(content)
+        if isinstance(content, np.ndarray):
+            return content.astype(np.uint8)
+        return binary_to_bits(str(content))
+
+    def get_distances(self, address, indexes=None):
+        addresses = self.addresses if indexes is None else self.addresses[indexes]
+        xor       = np.bitwise_xor(addresses, self.encode_address(address))
+        if self.is_partial_address(address):
+            # as hamming_distance, only the bits present in address are compared
+            xor &= pack_binary_address('1' * len(address), self.address_length)
+        return popcount(xor)
+
+    def is_partial_address(self, address):
+        return not isinstance(address, np.ndarray) and len(address) < self.address_length
+
+    def get_pair_distances(self, addresses1, addresses2):
+        rows1 = np.array([self.encode_address(address) for address in addresses1]).reshape(len(addresses1), -1)
+        rows2 = np.array([self.encode_address(address) for address in addresses2]).reshape(len(addresses2), -1)
+        return popcount(np.bitwise_xor(rows1, rows2))
+
+    def get_pair_bytes(self):
+        # the XOR of the packed rows and its popcount table lookup
+        return 33 + 2 * self.get_address_width(self.address_length)
+
+    def get_row_chunk_distances(self, rows, indexes):
+        return popcount(np.bitwise_xor(rows[:, np.newaxis, :], self.addresses[indexes][np.newaxis, :, :]))
+
+    def get_distance_matrix(self, addresses, indexes=None):
+        stored = self.addresses if indexes is None else self.addresses[indexes]
+        if isinstance(addresses, np.ndarray) and addresses.ndim == 2:
+            # one row of 0/1 bits per address
+            packed = np.packbits(addresses.astype(np.uint8), axis=1)
+            masks  = None
+        else:
+            # each one encoded on its own: a 0/1 row, a binary string or a BinaryAddress
+            packed = np.array([self.encode_address(address) for address in addresses])
+            masks  = None
+            if any(self.is_partial_address(address) for address in addresses):
+                # as hamming_distance, only the bits present in shorter addresses are compared
+                masks = np.array([pack_binary_address('1' * len(address), self.address_length)
+                                  if self.is_partial_address(address) else np.full(stored.shape[1], 255, np.uint8)
+                                  for address in addresses])
+        packed = packed.reshape(-1, stored.shape[1])
+        xor    = np.bitwise_xor(packed[:, np.newaxis, :], stored[np.newaxis, :, :])
+        if masks is not None:
+            xor &= masks.reshape(-1, 1, stored.shape[1])
+        return popcount(xor)
+
+
+class ArrayArithmeticSDM(ArraySDM):
     """
-    Address and Content are list of Integers as defined in
-       https://www.iaeng.org/IJCS/issues_v39/issue_4/IJCS_39_4_03.pdf
+    Same as ArithmeticSDM but addresses are kept in one (N, address_length) int16 matrix, the L1 distance to all
+    hard locations is computed by broadcasting and the learning rate is applied to all near rows at once
     """
+    address_dtype = np.int16
 
     def __init__(self, address_length, content_length, number_of_hard_locations, radius, learning_rate=1.0,
-                 values_per_dimension=255, hard_location_creation=HardLocationCreation.Nothing, debug=False):
+                 values_per_dimension=255, hard_location_creation=HardLocationCreation.Nothing, metric_index=False,
+                 eviction_policy=EvictionPolicy.Random, counter_type=int, n_threads=None, read_cache_size=None,
+                 float_content=False, array_values=False, seed=None, debug=False):
+        """
+        :param metric_index: if True keeps a PivotIndex so reads skip hard locations that can not be within radius
+        :param float_content: if True contents are real vectors (RealAddress, not clipped to the integers range)
+                              learned by float32 counters (unless counter_type is another float type)
+        """
         self.learning_rate = learning_rate
+        self.float_content = float_content
+        index = PivotIndex(address_length, IntegersAddress.min_value, IntegersAddress.max_value) \
+            if metric_index else None
         super().__init__(address_length, content_length, number_of_hard_locations, radius,
                          values_per_dimension=values_per_dimension, hard_location_creation=hard_location_creation,
-                         address_class=IntegersAddress, content_class=IntegersAddress, debug=debug)
+                         address_class=IntegersAddress,
+                         content_class=RealAddress if float_content else IntegersAddress,
+                         counter_type=get_content_counter_type(counter_type, float_content), index=index,
+                         eviction_policy=eviction_policy, n_threads=n_threads, read_cache_size=read_cache_size,
+                         array_values=array_values, seed=seed, debug=debug)
+
+    def encode_address(self, address):
+        value = address.value if isinstance(address, Address) else address
+        return np.asarray(value, dtype=self.address_dtype).ravel()
+
+    def decode_address(self, row):
+        return IntegersAddress(row.tolist())
+
+    def get_increments(self, content):
+        value = content.value if isinstance(content, Address) else content
+        return np.asarray(value, dtype=float).ravel()
+
+    def get_distances(self, address, indexes=None):
+        addresses = self.addresses if indexes is None else self.addresses[indexes]
+        return np.abs(addresses - self.encode_address(address)).sum(axis=1, dtype=np.int64)
+
+    def get_pair_distances(self, addresses1, addresses2):
+        rows1 = np.array([self.encode_address(address) for address in addresses1], dtype=np.int64)
+        rows2 = np.array([self.encode_address(address) for address in addresses2], dtype=np.int64)
+        return np.abs(rows1 - rows2).reshape(len(addresses1), -1).sum(axis=1)
+
+    def get_pair_bytes(self):
+        # the int16 differences and their absolute values
+        return 33 + 4 * self.address_length
+
+    def get_row_chunk_distances(self, rows, indexes):
+        # int16 differences as get_distance_matrix (values are in [0, 255])
+        return np.abs(rows[:, np.newaxis, :] - self.addresses[indexes][np.newaxis, :, :]).sum(axis=2, dtype=np.int64)
+
+    def get_distance_matrix(self, addresses, indexes=None):
+        stored  = self.addresses if indexes is None else self.addresses[indexes]
+        encoded = np.array([self.encode_address(address) for address in addresses], dtype=self.address_dtype)
+        encoded = encoded.reshape(-1, stored.shape[1])
+        return np.abs(encoded[:, np.newaxis, :] - stored[np.newaxis, :, :]).sum(axis=2, dtype=np.int64)
+
+    def update_counters(self, indexes, content):
+        counters               = self.counters[indexes]
+        self.counters[indexes] = saturate(counters + self.learning_rate * (self.get_increments(content) - counters),
+                                          self.counters.dtype)
+        self.store.updated(indexes)
+
+    def apply_writes(self, activations, increments):
+        if self.learning_rate != 1.0 and not np.issubdtype(self.counters.dtype, np.floating):
+            # integer counters are truncated after each write, so only applying them in order gives the same result
+            for i, activation in enumerate(activations):
+                self.update_counters(np.flatnonzero(activation), increments[i])
+            return
+        # after k writes: c = (1-lr)^k * c0 + sum_j lr * (1-lr)^(writes after j) * v_j
+        decay       = 1.0 - self.learning_rate
+        activations = activations.astype(float)
+        later       = np.cumsum(activations[::-1], axis=0)[::-1] - activations
+        weights     = activations * self.learning_rate * decay ** later
+        totals      = activations.sum(axis=0)
+        self.counters[:] = saturate((decay ** totals)[:, np.newaxis] * self.counters + weights.T @ increments,
+                                    self.counters.dtype)
+
+
+class MultiIndexHashing(object):
+    """
+    Index for Hamming radius search over packed binary addresses: addresses are split in radius+1 substrings
+    with one hash table per substring. By the pigeonhole principle any address within radius has at least one
+    substring equal to the query, so only the hard locations sharing a substring are candidates
+    see: https://www.cs.toronto.edu/~norouzi/research/papers/multi_index_hashing.pdf
+    """
 
-    def create_random_address(self):
-        return self.address_class.create_random(self.address_length)
+    def __init__(self, address_length, radius):
+        substrings  = max(1, min(radius + 1, address_length))
+        self.radius = substrings - 1  # max distance the pigeonhole principle holds for
+        self.bounds = np.linspace(0, address_length, substrings + 1).astype(int)
+        self.tables = [{} for _ in range(substrings)]
+
+    def get_keys(self, row):
+        bits = np.unpackbits(row)
+        return [bits[start:end].tobytes() for start, end in zip(self.bounds[:-1], self.bounds[1:])]
+
+    def add(self, i, row):
+        for table, key in zip(self.tables, self.get_keys(row)):
+            table.setdefault(key, set()).add(i)
+
+    def remove(self, i, row):
+        for table, key in zip(self.tables, self.get_keys(row)):
+            bucket = table.get(key)
+            if bucket is None:
+                continue
+            bucket.discard(i)
+            if len(bucket) == 0:
+                del table[key]
+
+    def rebuild(self, rows):
+        self.tables = [{} for _ in self.tables]
+        for i, row in enumerate(rows):
+            self.add(i, row)
+
+    def search(self, row, distance):
+        """
+        Returns the (sorted) indexes of the hard locations that can be within distance of row, None if the index
+        can not answer for that distance (it was built for a smaller radius)
+        :param row:
+        :param distance:
+        :return:
+        """
+        if distance > self.radius:
+            return None
+        candidates = set()
+        for table, key in zip(self.tables, self.get_keys(row)):
+            candidates.update(table.get(key, ()))
+        return np.array(sorted(candidates), dtype=np.int64)
 
-    def update_hard_location_counters(self, hard_location, content):
-        for i, value in enumerate(content):
-            hard_location[1][i] += self.learning_rate * \
-                                   (self.content_class.get_value_to_increment_counter(value) - hard_location[1][i])
+
+class PivotIndex(object):
+    """
+    Metric index for L1 radius search (LAESA like): the distance from every hard location to a few pivot
+    addresses is kept. By the triangle inequality |d(q, p) - d(x, p)| <= d(q, x), so a hard location whose bound
+    is bigger than the radius for any pivot can not be near the query and its full distance is never computed.
+    Pivots are the min and max corners of the address space plus random addresses, so they do not depend on the
+    hard locations and insert/delete are O(pivots * address_length)
+    """
+
+    def __init__(self, address_length, min_value, max_value, pivots_n=8, seed=None):
+        rng         = np.random.default_rng(seed)
+        corners     = [np.full(address_length, min_value), np.full(address_length, max_value)]
+        randoms     = [rng.integers(min_value, max_value + 1, address_length) for _ in range(max(0, pivots_n - 2))]
+        self.pivots = np.array(corners + randoms, dtype=np.int64)
+        self.table  = np.zeros((0, len(self.pivots)), dtype=np.int64)
+        self.active = np.zeros(0, dtype=bool)
+
+    def get_pivot_distances(self, row):
+        return np.abs(self.pivots - row.astype(np.int64)).sum(axis=1)
+
+    def add(self, i, row):
+        if i >= len(self.table):
+            added       = max(i + 1, 2 * len(self.table)) - len(self.table)
+            self.table  = np.concatenate([self.table, np.zeros((added, len(self.pivots)), dtype=self.table.dtype)])
+            self.active = np.concatenate([self.active, np.zeros(added, dtype=bool)])
+        self.table[i]  = self.get_pivot_distances(row)
+        self.active[i] = True
+
+    def remove(self, i, row):
+        self.active[i] = False
+
+    def rebuild(self, rows):
+        self.table  = np.abs(rows.astype(np.int64)[:, np.newaxis, :] - self.pivots[np.newaxis, :, :]).sum(axis=2)
+        self.table  = self.table.reshape(-1, len(self.pivots))
+        self.active = np.ones(len(rows), dtype=bool)
+
+    def search(self, row, distance):
+        """
+        Returns the indexes of the hard locations that can be within distance of row
+        :param row:
+        :param distance:
+        :return:
+        """
+        candidates = np.flatnonzero(self.active)
+        for j, pivot_distance in enumerate(self.get_pivot_distances(row)):
+            # each pivot only checks the hard locations that survived the previous ones
+            candidates = candidates[np.abs(self.table[candidates, j] - pivot_distance) <= distance]
+        return candidates
 
 
 # Hard location functions
@@ -352,7 +2211,7 @@ def create_random_hard_locations(number_of_hard_locations, max_possible_values,
         print('create %s random locations' % number_of_hard_locations)
     hard_locations = []
     for i in range(number_of_hard_locations):
-        j       = rn.randint(0, max_possible_values)
+        j       = rn.randint(0, max_possible_values - 1)
         address = address_class.create_address_from_number(j)
         hard_locations.append(create_hard_location(address, content_length))
         if debug:
@@ -360,6 +2219,41 @@ def create_random_hard_locations(number_of_hard_locations, max_possible_values,
     return hard_locations
 
 
+def create_random_digits(n, length, base, rng):
+    """
+    Returns a (n, length) matrix of random digits in [0, base)
+    :param n:
+    :param length:
+    :param base:
+    :param rng: numpy Generator
+    :return:
+    """
+    return rng.integers(0, base, (n, length), dtype=np.uint8 if base <= 256 else np.int64)
+
+
+def create_lattice_digits(first, n, step, base, length):
+    """
+    Returns the digits in base (most significant first) of the numbers first * step, (first + 1) * step, ... for
+    n rows. The product is done digit by digit with carries over all the rows at once, so step can be as big as the
+    address space (a Python integer) without building a number per row
+    :param first:
+    :param n:
+    :param step:
+    :param base:
+    :param length: digits of each number (higher digits are dropped)
+    :return:
+    """
+    step_digits = np.zeros(length, dtype=np.int64)
+    for column in range(length - 1, -1, -1):
+        step, step_digits[column] = divmod(step, base)
+    products = np.arange(first, first + n, dtype=np.int64)[:, np.newaxis] * step_digits
+    digits   = np.zeros((n, length), dtype=np.uint8 if base <= 256 else np.int64)
+    carry    = np.zeros(n, dtype=np.int64)
+    for column in range(length - 1, -1, -1):
+        carry, digits[:, column] = np.divmod(products[:, column] + carry, base)
+    return digits
+
+
 def create_uniform_hard_locations(number_of_hard_locations, max_possible_values, address_class, content_length,
                                   debug=False):
     distance = int(max_possible_values / number_of_hard_locations)
@@ -377,6 +2271,141 @@ def create_uniform_hard_locations(number_of_hard_locations, max_possible_values,
 
 
 # other functions
+def get_stream_batches(source, batch_size, address_length):
+    """
+    Yields the (addresses, contents) batches of the pairs of source (see SDM.fit_stream). Each side is a 2-D array
+    if source is a .npy file or yields NumPy rows, and a list otherwise
+    :param source:
+    :param batch_size:
+    :param address_length: columns of the address in each row of a .npy file
+    :return:
+    """
+    if isinstance(source, str) and source.endswith('.npy'):
+        rows = np.load(source, mmap_mode='r')
+        for start, end in get_chunks(len(rows), batch_size):
+            batch = np.asarray(rows[start:end])
+            yield batch[:, :address_length], batch[:, address_length:]
+        return
+    pairs     = iterate_jsonl_pairs(source) if isinstance(source, str) else iter(source)
+    addresses = []
+    contents  = []
+    for address, content in pairs:
+        addresses.append(address)
+        contents.append(content)
+        if len(addresses) == batch_size:
+            yield stack_rows(addresses), stack_rows(contents)
+            addresses = []
+            contents  = []
+    if addresses:
+        yield stack_rows(addresses), stack_rows(contents)
+
+
+def stack_rows(values):
+    """
+    Returns a list of values as a 2-D array if all of them are NumPy rows, else the list unchanged
+    :param values:
+    :return:
+    """
+    return np.stack(values) if all(isinstance(value, np.ndarray) for value in values) else values
+
+
+def iterate_jsonl_pairs(file_name):
+    """
+    Yields the (address, content) of each line of a .jsonl file
+    :param file_name:
+    :return:
+    """
+    if not file_name.endswith('.jsonl'):
+        raise Exception('Only .npy and .jsonl files can be streamed, not %s' % file_name)
+    with open(file_name) as jsonl_file:
+        for line in jsonl_file:
+            if line.strip():
+                pair = json.loads(line)
+                yield pair['address'], pair['content']
+
+
+def decode_values(values, address_class):
+    """
+    Returns a vector of values as expected by an SDM using address_class: a binary string or a list of integers
+    :param values:
+    :param address_class:
+    :return:
+    """
+    if issubclass(address_class, BinaryAddress):
+        return ''.join('1' if value else '0' for value in values)
+    return np.asarray(values).astype(int).tolist()
+
+
+def get_cache_key(address):
+    """
+    Returns a hashable key for address (raw value, Address or ndarray)
+    :param address:
+    :return:
+    """
+    value = address.value if isinstance(address, Address) else address
+    if isinstance(value, np.ndarray):
+        return value.dtype.str, value.shape, value.tobytes()
+    return repr(value)
+
+
+def get_smallest_positions(distances, k):
+    """
+    Returns the positions of the k smallest distances (in the last axis) with a partial sort, on ties the first
+    positions are returned
+    :param distances: integer distances
+    :param k:
+    :return:
+    """
+    n    = distances.shape[-1]
+    keys = distances.astype(np.int64) * n + np.arange(n)
+    return np.argpartition(keys, k - 1, axis=-1)[..., :k]
+
+
+def get_accumulator_type(counter_type):
+    """
+    Returns the type used to compute updates of counters of counter_type before saturating them
+    :param counter_type:
+    :return:
+    """
+    return np.float64 if np.issubdtype(counter_type, np.floating) else np.int64
+
+
+def get_content_counter_type(counter_type, float_content):
+    """
+    Returns the type of the counters: float32 for float contents unless counter_type is already a float type
+    :param counter_type:
+    :param float_content:
+    :return:
+    """
+    if float_content and not np.issubdtype(np.dtype(counter_type), np.floating):
+        return np.float32
+    return counter_type
+
+
+def saturate(values, counter_type):
+    """
+    Returns values as counter_type, integers out of its range are clipped to the limits instead of wrapping
+    :param values:
+    :param counter_type:
+    :return:
+    """
+    dtype = np.dtype(counter_type)
+    if np.issubdtype(dtype, np.integer):
+        limits = np.iinfo(dtype)
+        values = np.clip(values, limits.min, limits.max)
+    return np.asarray(values).astype(dtype)
+
+
+def get_chunks(n, chunk_size):
+    """
+    Returns the (start, end) of each chunk of at most chunk_size elements needed to cover n elements
+    :param n:
+    :param chunk_size:
+    :return:
+    """
+    return [(start, min(start + chunk_size, n)) for start in range(0, n, max(1, chunk_size))]
+
+
 def get_random_partition(n, k):
     """
     Returns a list of k elements whose total value is n
@@ -423,6 +2452,52 @@ def hamming_distance(binary1, binary2):
     return d
 
 
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed):
+    """
+    Returns the number of bits set in each row of a packed (uint8) matrix
+    :param packed:
+    :return:
+    """
+    return POPCOUNT_TABLE[packed].sum(axis=-1, dtype=np.int64)
+
+
+def bits_to_binary(bits):
+    """
+    Returns a vector of 0/1 values as a binary string (ex: '0110')
+    :param bits:
+    :return:
+    """
+    return (np.asarray(bits, dtype=np.uint8) + ord('0')).tobytes().decode('ascii')
+
+
+def binary_to_bits(binary):
+    """
+    Returns a binary string (ex: '0110') as an uint8 vector of 0/1
+    :param binary:
+    :return:
+    """
+    return (np.frombuffer(binary.encode('ascii'), dtype=np.uint8) == ord('1')).astype(np.uint8)
+
+
+def pack_binary_address(binary, length):
+    """
+    Returns a binary string packed 8 bits per byte, if shorter than length it is padded with zeros
+    :param binary:
+    :param length:
+    :return:
+    """
+    bits = np.zeros(length, dtype=np.uint8)
+    bits[:min(len(binary), length)] = binary_to_bits(binary[:length])
+    return np.packbits(bits)
+
+
+def unpack_binary_address(packed, length):
+    return (np.unpackbits(packed)[:length] + ord('0')).tobytes().decode('ascii')
+
+
 def get_int_in_range(value, min_value, max_value):
     i = int(value)
     i = max(min_value, min(max_value, i))
@@ -472,19 +2547,149 @@ def test_create_uniform_hard_locations(number_of_hard_locations, max_possible_va
     return len(hard_locations)
 
 
+def test_initialization(sdm_name, hard_location_creation, number_of_hard_locations, address_length, seed):
+    """
+    Returns [hard locations created, if another SDM with the same seed has the same addresses, distinct addresses]
+    """
+    sdm_class = globals()[sdm_name]
+    sdms      = [sdm_class(address_length, 4, number_of_hard_locations, 1,
+                           hard_location_creation=hard_location_creation, seed=seed) for _ in range(2)]
+    addresses = [[str(address) for address, _ in sdm.hard_locations] for sdm in sdms]
+    return [len(sdms[0].store), addresses[0] == addresses[1], len(set(addresses[0]))]
+
+
+def test_lattice_digits(first, n, step, base, length):
+    """
+    Returns True if create_lattice_digits gives the same digits as converting each number (as a Python integer)
+    """
+    digits   = create_lattice_digits(first, n, step, base, length)
+    expected = []
+    for j in range(first, first + n):
+        number = (j * step) % base ** length
+        row    = []
+        for _ in range(length):
+            number, digit = divmod(number, base)
+            row.insert(0, digit)
+        expected.append(row)
+    return digits.tolist() == expected
+
+
+def test_hard_location_store(capacity, first_adds, removes, second_adds):
+    """
+    Returns [size, capacity, slots in use] after adding, removing (freed slots are reused) and adding again
+    """
+    store = HardLocationStore(capacity, 2, address_width=3, address_dtype=np.uint8)
+    for i in range(first_adds):
+        store.add([i, i, i])
+    for slot in removes:
+        store.remove(slot)
+    for i in range(second_adds):
+        store.add([i, i, i])
+    return [len(store), store.capacity(), store.get_slots().tolist()]
+
+
+def test_on_demand_capacity(sdm_name, number_of_hard_locations, writes_n):
+    """
+    Returns the number of hard locations after many writes on demand (it can not exceed number_of_hard_locations)
+    """
+    if sdm_name == 'BinarySDM':
+        sdm = BinarySDM(16, 4, number_of_hard_locations, 2, hard_location_creation=HardLocationCreation.OnDemand)
+    else:
+        sdm = PackedBinarySDM(16, 4, number_of_hard_locations, 2, hard_location_creation=HardLocationCreation.OnDemand)
+    for _ in range(writes_n):
+        sdm.write(''.join(rn.choice('01') for _ in range(16)), '1010')
+    return len(sdm.hard_locations)
+
+
+def test_eviction_policy(policy_name, content_a, content_b, content_c):
+    """
+    Room for 2 addresses (3 hard locations each): writes A and B, reads A and writes C, so B's hard locations
+    must be evicted. Returns the content read in A, B and C
+    """
+    sdm = PackedBinarySDM(16, 4, 6, 1, hard_location_creation=HardLocationCreation.OnDemand,
+                          eviction_policy=EvictionPolicy[policy_name])
+    address_a = '0000000000000000'
+    address_b = '1111111111111111'
+    address_c = '0000000011111111'
+    sdm.write(address_a, content_a)
+    sdm.write(address_b, content_b)
+    sdm.read(address_a)
+    sdm.write(address_c, content_c)
+    return [sdm.read(address_a), sdm.read(address_b), sdm.read(address_c)]
+
+
+def test_least_activated_reads(writes_n, reads_n):
+    """
+    Writes and reads random addresses in an arithmetic SDM with the LeastActivated policy. Returns True if the reads
+    did not add heap entries, and if the hard location selected for eviction is the one with the lowest key
+    """
+    sdm = ArrayArithmeticSDM(4, 4, 60, 150, learning_rate=0.5, hard_location_creation=HardLocationCreation.OnDemand,
+                             eviction_policy=EvictionPolicy.LeastActivated, seed=1)
+    for _ in range(writes_n):
+        sdm.write(sdm.create_random_address().value, sdm.create_random_address().value)
+    heap_n = len(sdm.eviction.heap)
+    for _ in range(reads_n):
+        sdm.read(sdm.create_random_address().value)
+    lowest = min(sdm.store.get_slots().tolist(), key=lambda slot: sdm.eviction.get_key(sdm.store, slot))
+    return len(sdm.eviction.heap) == heap_n and sdm.eviction.select(sdm.store, 1, []) == [lowest]
+
+
+def test_random_eviction_seed(seed, writes_n):
+    """
+    Returns True if two SDMs with the same seed evict the same hard locations with the Random policy
+    """
+    sdms = [PackedBinarySDM(32, 8, 30, 6, hard_location_creation=HardLocationCreation.OnDemand, seed=seed)
+            for _ in range(2)]
+    rng  = np.random.default_rng(seed)
+    for row in create_random_digits(writes_n, 32, 2, rng):
+        for sdm in sdms:
+            sdm.write(bits_to_binary(row), bits_to_binary(row[:8]))
+    return [str(address) for address, _ in sdms[0].hard_locations] == \
+        [str(address) for address, _ in sdms[1].hard_locations]
+
+
+def test_save_load(sdm_name, mmap, writes_n):
+    """
+    Returns True if an SDM loaded from a saved one reads the same values
+    """
+    if sdm_name == 'BinarySDM':
+        sdm = BinarySDM(16, 8, 50, 3, hard_location_creation=HardLocationCreation.OnDemand)
+    elif sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(16, 8, 50, 3, hard_location_creation=HardLocationCreation.OnDemand, multi_index=True,
+                              eviction_policy=EvictionPolicy.LRU)
+    else:
+        sdm = ArrayArithmeticSDM(4, 4, 50, 60, learning_rate=0.5, hard_location_creation=HardLocationCreation.Random)
+    addresses = [sdm.create_random_address().value for _ in range(writes_n)]
+    for address in addresses:
+        sdm.write(address, address if sdm_name == 'ArrayArithmeticSDM' else address[:8])
+    with tempfile.TemporaryDirectory() as path:
+        sdm.save(path)
+        loaded = SDM.load(path, mmap=mmap)
+        same   = [sdm.read(address) for address in addresses] == [loaded.read(address) for address in addresses]
+        del loaded
+    return same
+
+
 def test_binary_sdm_write_read(address_length, content_length, number_of_hard_locations, radius, debug, hard_locations,
                                writes, reads):
     hard_location_creation = HardLocationCreation.OnDemand if len(hard_locations) == 0 else HardLocationCreation.Nothing
     sdm = BinarySDM(address_length, content_length, number_of_hard_locations, radius,
                     hard_location_creation=hard_location_creation, debug=debug)
-    sdm.hard_locations = [create_hard_location(sdm.address_class(address), content_length)
-                          for address in hard_locations]
-    for [address, content] in writes:
-        sdm.write(address, content)
-    if debug:
-        sdm.print_hard_locations(title='Hard locations after write')
-    values = [sdm.read(read) for read in reads]
-    return values
+    return sdm_write_read(sdm, hard_locations, writes, reads, debug)
+
+
+def test_packed_binary_sdm_write_read(address_length, content_length, number_of_hard_locations, radius, debug,
+                                      hard_locations, writes, reads):
+    hard_location_creation = HardLocationCreation.OnDemand if len(hard_locations) == 0 else HardLocationCreation.Nothing
+    sdm = PackedBinarySDM(address_length, content_length, number_of_hard_locations, radius,
+                          hard_location_creation=hard_location_creation, debug=debug)
+    return sdm_write_read(sdm, hard_locations, writes, reads, debug)
+
+
+def test_packed_hamming_distance(address, hard_locations):
+    sdm = PackedBinarySDM(len(address), 1, len(hard_locations), 0)
+    sdm.hard_locations = [create_hard_location(hard_location, 1) for hard_location in hard_locations]
+    return [int(distance) for distance in sdm.get_distances(address)]
 
 
 def test_arithmetic_sdm_write_read(address_length, content_length, number_of_hard_locations, radius, debug,
@@ -492,7 +2697,607 @@ def test_arithmetic_sdm_write_read(address_length, content_length, number_of_har
     hard_location_creation = HardLocationCreation.OnDemand if len(hard_locations) == 0 else HardLocationCreation.Nothing
     sdm = ArithmeticSDM(address_length, content_length, number_of_hard_locations, radius,
                         hard_location_creation=hard_location_creation, debug=debug)
-    sdm.hard_locations = [create_hard_location(sdm.address_class(address), content_length)
+    return sdm_write_read(sdm, hard_locations, writes, reads, debug)
+
+
+def test_packed_partial_address(address, hard_locations):
+    """
+    Returns True if the distances to a BinaryAddress shorter than address_length are the ones of its string
+    """
+    sdm = PackedBinarySDM(len(hard_locations[0]), 1, len(hard_locations), 0)
+    sdm.hard_locations = [create_hard_location(hard_location, 1) for hard_location in hard_locations]
+    return np.array_equal(sdm.get_distances(BinaryAddress(address)), sdm.get_distances(address))
+
+
+def test_array_arithmetic_sdm_write_read(address_length, content_length, number_of_hard_locations, radius, debug,
+                                         hard_locations, writes, reads):
+    hard_location_creation = HardLocationCreation.OnDemand if len(hard_locations) == 0 else HardLocationCreation.Nothing
+    sdm = ArrayArithmeticSDM(address_length, content_length, number_of_hard_locations, radius,
+                             hard_location_creation=hard_location_creation, debug=debug)
+    return sdm_write_read(sdm, hard_locations, writes, reads, debug)
+
+
+def test_array_arithmetic_distance(address, hard_locations):
+    sdm = ArrayArithmeticSDM(len(address), 1, len(hard_locations), 0)
+    sdm.hard_locations = [create_hard_location(hard_location, 1) for hard_location in hard_locations]
+    return [int(distance) for distance in sdm.get_distances(address)]
+
+
+def test_write_read_many(sdm_name, address_length, content_length, number_of_hard_locations, radius, learning_rate,
+                         writes_n, chunk_size, rows=False):
+    """
+    Returns True if write_many/read_many give the same result as calling write/read one by one
+    :param rows: PackedBinarySDM only, write_many/read_many get lists of 0/1 NumPy rows instead of strings
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdms = [PackedBinarySDM(address_length, content_length, number_of_hard_locations, radius,
+                                hard_location_creation=HardLocationCreation.Random) for _ in range(2)]
+        addresses = [sdms[0].create_random_address().value for _ in range(writes_n)]
+        contents  = [''.join(rn.choice('01') for _ in range(content_length)) for _ in range(writes_n)]
+    else:
+        sdms = [ArrayArithmeticSDM(address_length, content_length, number_of_hard_locations, radius,
+                                   learning_rate=learning_rate, hard_location_creation=HardLocationCreation.Random)
+                for _ in range(2)]
+        addresses = [sdms[0].create_random_address().value for _ in range(writes_n)]
+        contents  = [IntegersAddress.create_random(content_length).value for _ in range(writes_n)]
+    sdms[1].hard_locations = sdms[0].hard_locations
+    for address, content in zip(addresses, contents):
+        sdms[0].write(address, content)
+    values1 = [sdms[0].read(address) for address in addresses]
+    if rows:
+        addresses = [binary_to_bits(address) for address in addresses]
+        contents  = [binary_to_bits(content) for content in contents]
+    sdms[1].write_many(addresses, contents, chunk_size=chunk_size)
+    values2 = sdms[1].read_many(addresses, chunk_size=chunk_size)
+    return values1 == values2 and np.array_equal(sdms[0].counters, sdms[1].counters)
+
+
+def test_threaded_read(sdm_name, n_threads, block_size, writes_n):
+    """
+    Returns True if an SDM scanning its hard locations in blocks with a thread pool writes and reads the same
+    values as the same SDM without threads
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdms = [PackedBinarySDM(32, 8, 500, 12, hard_location_creation=HardLocationCreation.Random,
+                                n_threads=threads) for threads in [None, n_threads]]
+        contents = [''.join(rn.choice('01') for _ in range(8)) for _ in range(writes_n)]
+    else:
+        sdms = [ArrayArithmeticSDM(4, 4, 500, 150, learning_rate=0.5,
+                                   hard_location_creation=HardLocationCreation.Random, n_threads=threads)
+                for threads in [None, n_threads]]
+        contents = [IntegersAddress.create_random(4).value for _ in range(writes_n)]
+    addresses = [sdms[0].create_random_address().value for _ in range(writes_n)]
+    sdms[1].hard_locations = sdms[0].hard_locations
+    sdms[1].block_size     = block_size
+    for sdm in sdms:
+        for address, content in zip(addresses, contents):
+            sdm.write(address, content)
+        sdm.write_many(addresses, contents)
+    same = [sdms[0].read(address) for address in addresses] == [sdms[1].read(address) for address in addresses]
+    return same and sdms[0].read_many(addresses) == sdms[1].read_many(addresses) and \
+        np.array_equal(sdms[0].counters, sdms[1].counters)
+
+
+def test_read_cache(sdm_name, read_cache_size, writes_n, reads_per_write):
+    """
+    Returns True if an SDM with a read cache reads the same values as scanning its hard locations while hot
+    addresses are read between writes, and the cache was used
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(32, 8, 300, 12, hard_location_creation=HardLocationCreation.Random,
+                              read_cache_size=read_cache_size)
+        contents = [''.join(rn.choice('01') for _ in range(8)) for _ in range(writes_n)]
+    elif sdm_name == 'ArithmeticSDM':
+        sdm = ArithmeticSDM(4, 4, 300, 150, learning_rate=0.5, read_cache_size=read_cache_size)
+        sdm.hard_locations = [create_hard_location(IntegersAddress.create_random(4), 4) for _ in range(300)]
+        contents = [IntegersAddress.create_random(4).value for _ in range(writes_n)]
+    else:
+        sdm = ArrayArithmeticSDM(4, 4, 300, 150, learning_rate=0.5,
+                                 hard_location_creation=HardLocationCreation.OnDemand, read_cache_size=read_cache_size)
+        contents = [IntegersAddress.create_random(4).value for _ in range(writes_n)]
+    addresses = [sdm.create_random_address().value for _ in range(writes_n)]
+    hot       = addresses[:5]
+    for address, content in zip(addresses, contents):
+        sdm.write(address, content)
+        for _ in range(reads_per_write):
+            read               = rn.choice(hot)
+            near_indexes, sums = sdm.get_near_sums(read)
+            if sdm.read(read) != sdm.get_value_from_sums(sums, len(near_indexes)):
+                return False
+    return sdm.read_cache.get_stats()['hits'] > 0
+
+
+def test_read_cache_invalidation():
+    """
+    Returns if a cached read is still valid after a write to other hard locations and after a write to its own
+    """
+    sdm = PackedBinarySDM(16, 4, 10, 2, read_cache_size=10)
+    sdm.hard_locations = [create_hard_location(BinaryAddress(address), 4) for address in ['0' * 16, '1' * 16]]
+    sdm.write('0' * 16, '1010')
+    sdm.read('0' * 16)
+    sdm.write('1' * 16, '0110')
+    sdm.read('0' * 16)
+    after_other = sdm.read_cache.get_stats()['hits'] == 1
+    sdm.write('0' * 16, '1111')
+    value = sdm.read('0' * 16)
+    stats = sdm.read_cache.get_stats()
+    return [after_other, stats['invalidations'] == 1, value]
+
+
+def test_read_cache_allocation(sdm_name):
+    """
+    Returns if a cached read is still valid after adding a hard location far from it, after removing one it did not
+    use, and if it is dropped after adding a near one and after removing one it used. Then if reads give the
+    same values as without cache
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm       = PackedBinarySDM(16, 4, 10, 2, read_cache_size=10)
+        locations = ['0' * 16, '1' * 16, '0' * 15 + '1', '0' * 8 + '1' * 8]
+    else:
+        sdm       = ArrayArithmeticSDM(4, 4, 10, 5, read_cache_size=10)
+        locations = [[0, 0, 0, 0], [200, 200, 200, 200], [0, 0, 0, 3], [100, 100, 0, 0]]
+    sdm.hard_locations = [create_hard_location(sdm.address_class(locations[0]), 4),
+                          create_hard_location(sdm.address_class(locations[1]), 4)]
+    sdm.write(locations[0], locations[0][:4])
+    sdm.read(locations[0])
+    results = []
+    far     = sdm.store.add(sdm.encode_address(locations[3]))
+    sdm.read(locations[0])
+    results.append(sdm.read_cache.get_stats()['hits'] == 1)
+    sdm.store.remove(far)
+    sdm.read(locations[0])
+    results.append(sdm.read_cache.get_stats()['hits'] == 2)
+    near = sdm.store.add(sdm.encode_address(locations[2]))
+    sdm.read(locations[0])
+    results.append(sdm.read_cache.get_stats()['invalidations'] == 1)
+    sdm.store.remove(near)
+    sdm.read(locations[0])
+    results.append(sdm.read_cache.get_stats()['invalidations'] == 2)
+    near_indexes, sums = sdm.get_near_sums(locations[0])
+    return results + [sdm.read(locations[0]) == sdm.get_value_from_sums(sums, len(near_indexes))]
+
+
+def test_read_mode(sdm_name, read_mode, k, reads_n):
+    """
+    Returns True if the hard locations read in read_mode are the expected ones (the k nearest, or at most k of the
+    near ones) and read_many reads the same values as read
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(32, 8, 300, 12, hard_location_creation=HardLocationCreation.Random)
+    elif sdm_name == 'ArithmeticSDM':
+        sdm = ArithmeticSDM(4, 4, 300, 150)
+        sdm.hard_locations = [create_hard_location(IntegersAddress.create_random(4), 4) for _ in range(300)]
+    else:
+        sdm = ArrayArithmeticSDM(4, 4, 300, 150, hard_location_creation=HardLocationCreation.Random)
+    addresses = [sdm.create_random_address().value for _ in range(reads_n)]
+    for address in addresses:
+        content = ''.join(rn.choice('01') for _ in range(8)) if sdm_name == 'PackedBinarySDM' else address
+        sdm.write(address, content)
+    sdm.set_read_mode(read_mode, k)
+    for address in addresses:
+        slots     = sdm.get_read_indexes(address)
+        distances = sdm.get_distances(address, sdm.store.get_slots())
+        if read_mode == ReadMode.KNearest:
+            ok = len(slots) == k and np.sort(distances)[k - 1] == sdm.get_distances(address, slots).max()
+        else:
+            ok = len(slots) <= k and set(slots) <= set(sdm.get_near_indexes(address, sdm.radius))
+        if not ok:
+            return False
+    if read_mode == ReadMode.Sampled:
+        return True
+    return [sdm.read(address) for address in addresses] == sdm.read_many(addresses)
+
+
+def test_counter_type(sdm_name, counter_type, writes_n, batch):
+    """
+    Writes the same content writes_n times in the same address, returns the minimum and maximum counters (they
+    must saturate instead of wrapping) and if the content is still read back
+    """
+    if sdm_name == 'BinarySDM':
+        sdm = BinarySDM(8, 4, 4, 2, counter_type=counter_type)
+    elif sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(8, 4, 4, 2, counter_type=counter_type)
+    elif sdm_name == 'ArithmeticSDM':
+        sdm = ArithmeticSDM(4, 4, 4, 2, learning_rate=0.5, counter_type=counter_type)
+    else:
+        sdm = ArrayArithmeticSDM(4, 4, 4, 2, counter_type=counter_type)
+    address, content = ('00001111', '1011') if 'Binary' in sdm_name else ([10, 20, 30, 40], [0, 100, 200, 250])
+    sdm.hard_locations = [create_hard_location(sdm.address_class(address), 4, counter_type=counter_type)]
+    if batch:
+        sdm.write_many([address] * writes_n, [content] * writes_n)
+    else:
+        for _ in range(writes_n):
+            sdm.write(address, content)
+    counters = sdm.store.counters[sdm.store.get_slots()]
+    return [int(counters.min()), int(counters.max()), sdm.read(address) == content]
+
+
+def test_memory_footprint(sdm_name, counter_type):
+    """
+    Returns the bytes used by the counters of each hard location
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(256, 256, 1000, 100, counter_type=counter_type)
+    else:
+        sdm = ArrayArithmeticSDM(16, 16, 1000, 100, counter_type=counter_type)
+    footprint = sdm.get_memory_footprint()
+    return footprint['counters'] // sdm.store.capacity()
+
+
+def test_read_iterative(sdm_name, max_iters, tol, noise, array_values=False):
+    """
+    Stores some patterns (autoassociative) and reads noisy versions of them iteratively. Returns True if the
+    batched result and the iteration counts are the same as feeding read back one query at a time, and with
+    array_values the same as without it
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm      = PackedBinarySDM(64, 64, 1000, 24, hard_location_creation=HardLocationCreation.Random, seed=1)
+        patterns = [''.join(rn.choice('01') for _ in range(64)) for _ in range(10)]
+        queries  = [''.join(bit if rn.random() > noise else rn.choice('01') for bit in pattern)
+                    for pattern in patterns]
+    else:
+        sdm      = ArrayArithmeticSDM(4, 4, 1000, 200, learning_rate=0.5,
+                                      hard_location_creation=HardLocationCreation.Random, seed=1)
+        patterns = [IntegersAddress.create_random(4).value for _ in range(10)]
+        queries  = [[IntegersAddress.get_value_in_range(value + rn.randint(-noise, noise)) for value in pattern]
+                    for pattern in patterns]
+    for pattern in patterns:
+        sdm.write(pattern, pattern)
+    values, iterations = sdm.read_iterative(queries, max_iters=max_iters, tol=tol)
+    if array_values:
+        sdm.array_values = True
+        rows, row_iterations = sdm.read_iterative(queries, max_iters=max_iters, tol=tol)
+        sdm.array_values = False
+        if not np.array_equal(iterations, row_iterations) or \
+                not all(np.array_equal(sdm.content_class.get_digits(value), row) for value, row in zip(values, rows)):
+            return False
+    for query, value, query_iterations in zip(queries, values, iterations):
+        expected = query
+        for i in range(max_iters):
+            content  = sdm.read(expected)
+            distance = sdm.get_pair_distances([expected], [content])[0]
+            expected = content
+            if distance <= tol:
+                break
+        if value != expected or query_iterations != i + 1:
+            return False
+    return True
+
+
+def test_stats(sdm_name, hard_location_creation, writes_n):
+    """
+    Writes and reads writes_n random addresses with stats enabled and returns the operations timed, if the hook was
+    called once per timed operation, and if nothing was recorded after disabling them
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(64, 64, 300, 24, hard_location_creation=hard_location_creation, seed=1)
+    else:
+        sdm = ArrayArithmeticSDM(4, 4, 300, 150, hard_location_creation=hard_location_creation, seed=1)
+    calls = []
+    sdm.enable_stats(hook=lambda operation, seconds: calls.append(operation))
+    addresses = [sdm.create_random_address().value for _ in range(writes_n)]
+    for address in addresses:
+        sdm.write(address, sdm.create_random_address().value)
+        sdm.read(address)
+    stats     = sdm.get_stats()
+    latencies = stats['latencies']
+    same      = len(calls) == sum(histogram['count'] for histogram in latencies.values())
+    same      = same and latencies['read']['count'] == writes_n == stats['values']['read_activations']['count']
+    sdm.disable_stats()
+    sdm.write(addresses[0], addresses[0])
+    return [sorted(latencies.keys()), same, stats['counters']['distance_evaluations'] > 0, sdm.get_stats()]
+
+
+def test_calibrate_radius(sdm_name, target_activations, target_fraction):
+    """
+    Returns True if the mean number of hard locations near random addresses with the calibrated radius is within a
+    factor of 2 of the target, and the one estimated by calibrate_radius is not below it
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(256, 8, 5000, 0, hard_location_creation=HardLocationCreation.Random, seed=1)
+    elif sdm_name == 'BinarySDM':
+        sdm = BinarySDM(32, 8, 1000, 0, hard_location_creation=HardLocationCreation.Random, seed=1)
+    else:
+        sdm = ArrayArithmeticSDM(8, 4, 5000, 0, hard_location_creation=HardLocationCreation.Random, seed=1)
+    radius, estimated = sdm.calibrate_radius(target_activations=target_activations, target_fraction=target_fraction)
+    target    = target_activations if target_activations is not None else target_fraction * len(sdm.store)
+    distances = sdm.get_row_distances(sdm.create_random_addresses(300), sdm.store.get_slots())
+    mean      = (distances <= radius).sum(axis=1).mean()
+    return sdm.radius == radius and estimated >= target and target / 2 <= mean <= target * 2
+
+
+def test_recalibration(recalibrate_every, writes_n):
+    """
+    Returns True if an SDM with hard locations created on demand calibrates its radius again as they are added
+    """
+    sdm = PackedBinarySDM(128, 128, 2000, 40, hard_location_creation=HardLocationCreation.OnDemand, seed=1)
+    sdm.enable_stats()
+    for _ in range(10):
+        sdm.write(sdm.create_random_address().value, sdm.create_random_address().value)
+    sdm.calibrate_radius(target_activations=3, recalibrate_every=recalibrate_every)
+    for _ in range(writes_n):
+        sdm.write(sdm.create_random_address().value, sdm.create_random_address().value)
+    calibrations = sdm.get_stats()['counters']['calibrations']
+    return calibrations > 1 if recalibrate_every else calibrations == 1
+
+
+def test_fit_stream(sdm_name, source_kind, pairs_n, batch_size):
+    """
+    Streams random pairs from a generator (of values or of NumPy rows) or a file into an SDM and writes them one by
+    one in an equal one. Returns True if both read the same, the pairs and batches reported and the number of
+    progress reports
+    """
+    def create_sdm():
+        if sdm_name == 'PackedBinarySDM':
+            return PackedBinarySDM(64, 16, 500, 26, hard_location_creation=HardLocationCreation.Random, seed=1)
+        if sdm_name == 'BinarySDM':
+            return BinarySDM(32, 8, 200, 12, hard_location_creation=HardLocationCreation.Random, seed=1)
+        return ArrayArithmeticSDM(4, 4, 500, 150, hard_location_creation=HardLocationCreation.Random, seed=1)
+
+    sdms    = [create_sdm(), create_sdm()]
+    rng     = np.random.default_rng(2)
+    lengths = [sdms[0].address_length, sdms[0].content_length]
+    rows    = np.hstack([create_random_digits(pairs_n, length, sdms[0].values_per_dimensions, rng)
+                         for length in lengths])
+    pairs   = [(decode_values(row[:lengths[0]], sdms[0].address_class),
+                decode_values(row[lengths[0]:], sdms[0].content_class)) for row in rows]
+    for address, content in pairs:
+        sdms[0].write(address, content)
+    reports = []
+    with tempfile.TemporaryDirectory() as path:
+        if source_kind == 'npy':
+            source = os.path.join(path, 'pairs.npy')
+            np.save(source, rows)
+        elif source_kind == 'jsonl':
+            source = os.path.join(path, 'pairs.jsonl')
+            with open(source, 'w') as jsonl_file:
+                for address, content in pairs:
+                    jsonl_file.write(json.dumps({'address': address, 'content': content}) + '\n')
+        elif source_kind == 'rows':
+            source = ((row[:lengths[0]], row[lengths[0]:]) for row in rows)
+        else:
+            source = (pair for pair in pairs)
+        report = sdms[1].fit_stream(source, batch_size=batch_size, progress=reports.append, progress_every=2)
+    addresses = [address for address, _ in pairs]
+    same      = sdms[0].read_many(addresses) == sdms[1].read_many(addresses)
+    return [same, report['pairs'], report['batches'], len(reports)]
+
+
+def test_float_content(sdm_name, writes_n, batch):
+    """
+    Writes random real vectors (with write or write_many) in an SDM with float_content and returns True if read and
+    read_many give the mean of the counters of the near hard locations, computed with float64 counters updated one
+    write at a time, and the type of the counters and the values read
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = PackedBinarySDM(64, 16, 500, 26, hard_location_creation=HardLocationCreation.Random, float_content=True,
+                              seed=1)
+    else:
+        sdm = ArrayArithmeticSDM(4, 16, 500, 150, learning_rate=0.5, hard_location_creation=HardLocationCreation.Random,
+                                 float_content=True, seed=1)
+    rng       = np.random.default_rng(2)
+    addresses = [sdm.create_random_address().value for _ in range(writes_n)]
+    contents  = rng.standard_normal((writes_n, 16)).astype(np.float32)
+    expected  = sdm.counters.astype(np.float64)
+    for address, content in zip(addresses, contents):
+        near = sdm.get_near_indexes(address, sdm.radius)
+        if sdm_name == 'PackedBinarySDM':
+            expected[near] += content
+        else:
+            expected[near] += sdm.learning_rate * (content - expected[near])
+    if batch:
+        sdm.write_many(addresses, contents)
+    else:
+        for address, content in zip(addresses, contents):
+            sdm.write(address, content)
+    values = [sdm.read(address) for address in addresses]
+    same   = all(np.allclose(value, expected[sdm.get_near_indexes(address, sdm.radius)].mean(axis=0), atol=1e-4)
+                 for address, value in zip(addresses, values))
+    same   = same and np.allclose(np.array(values), np.array(sdm.read_many(addresses)), atol=1e-4)
+    return [same, sdm.counters.dtype.name, values[0].dtype.name]
+
+
+def test_address_lengths(address_lengths, writes_n):
+    """
+    Creates on demand hard locations in binary SDMs of different address lengths at the same time. Returns the
+    lengths of their hard locations, if nested iterations over an address see all its values and if addresses
+    have no per instance dictionary
+    """
+    sdms = [BinarySDM(length, 8, 100, length // 4, hard_location_creation=HardLocationCreation.OnDemand)
+            for length in address_lengths]
+    for _ in range(writes_n):
+        for sdm in sdms:
+            sdm.write(sdm.create_random_address().value, sdm.create_random_address().value[:8])
+    lengths = [sorted(set(len(address) for address, _ in sdm.hard_locations)) for sdm in sdms]
+    address = BinaryAddress('0110')
+    nested  = [a + b for a in address for b in address]
+    return [lengths, len(nested) == 16, hasattr(address, '__dict__')]
+
+
+def test_array_values(sdm_name, writes_n):
+    """
+    Returns True if an SDM reading NumPy arrays (array_values) reads the same values as an equal one reading binary
+    strings or lists, and the type of the arrays read
+    """
+    def create_sdm(array_values):
+        if sdm_name == 'PackedBinarySDM':
+            return PackedBinarySDM(64, 16, 500, 24, hard_location_creation=HardLocationCreation.Random,
+                                   array_values=array_values, seed=1)
+        if sdm_name == 'BinarySDM':
+            return BinarySDM(32, 8, 200, 10, hard_location_creation=HardLocationCreation.Random,
+                             array_values=array_values, seed=1)
+        return ArrayArithmeticSDM(4, 4, 500, 150, learning_rate=0.5, hard_location_creation=HardLocationCreation.Random,
+                                  array_values=array_values, seed=1)
+
+    sdms      = [create_sdm(False), create_sdm(True)]
+    addresses = [sdms[0].create_random_address().value for _ in range(writes_n)]
+    contents  = [sdms[0].create_random_address().value[:sdms[0].content_length] for _ in range(writes_n)]
+    for sdm in sdms:
+        sdm.write_many(addresses, contents)
+    addresses = addresses + [sdms[0].create_random_address().value for _ in range(writes_n)]
+    values    = [decode_values(value, sdms[0].content_class) for value in sdms[1].read_many(addresses)]
+    same      = values == sdms[0].read_many(addresses)
+    same      = same and [decode_values(sdms[1].read(address), sdms[0].content_class) for address in addresses] == \
+        [sdms[0].read(address) for address in addresses]
+    return [same, sdms[1].read(addresses[0]).dtype.name]
+
+
+def test_create_near_digits(address_class_name, rows_n, length, distance, seed):
+    """
+    Returns True if all the near addresses generated at once are exactly at distance from their row, and if the
+    same seed generates the same addresses
+    """
+    address_class = globals()[address_class_name]
+    rng           = np.random.default_rng(seed)
+    if address_class == BinaryAddress:
+        digits = rng.integers(0, 2, (rows_n, length))
+    else:
+        # far enough from the limits to always fit
+        digits = rng.integers(distance, IntegersAddress.max_value - distance + 1, (rows_n, length))
+    distances = np.full(rows_n, distance)
+    near      = [address_class.create_near_digits(digits, distances, np.random.default_rng(seed)) for _ in range(2)]
+    exact     = np.array_equal(np.abs(near[0].astype(np.int64) - digits).sum(axis=1), distances)
+    return exact and np.array_equal(near[0], near[1])
+
+
+def test_on_demand_near(sdm_name, writes_n):
+    """
+    Returns True if after each write with hard locations created on demand there are at least
+    min_near_hard_locations near the address, and two SDMs with the same seed create the same hard locations
+    """
+    def create_sdm():
+        if sdm_name == 'PackedBinarySDM':
+            return PackedBinarySDM(64, 8, 10000, 10, hard_location_creation=HardLocationCreation.OnDemand, seed=3)
+        if sdm_name == 'BinarySDM':
+            return BinarySDM(32, 8, 10000, 6, hard_location_creation=HardLocationCreation.OnDemand, seed=3)
+        return ArrayArithmeticSDM(8, 8, 10000, 40, hard_location_creation=HardLocationCreation.OnDemand, seed=3)
+
+    sdms    = [create_sdm(), create_sdm()]
+    rng     = np.random.default_rng(4)
+    lengths = [sdms[0].address_length, sdms[0].content_length]
+    rows    = [create_random_digits(writes_n, length, sdms[0].values_per_dimensions, rng) for length in lengths]
+    covered = True
+    for address, content in zip(*rows):
+        address = decode_values(address, sdms[0].address_class)
+        content = decode_values(content, sdms[0].content_class)
+        for sdm in sdms:
+            sdm.write(address, content)
+        covered = covered and len(sdms[0].get_near_indexes(address, sdms[0].radius)) >= sdms[0].min_near_hard_locations
+    same = [str(address) for address, _ in sdms[0].hard_locations] == \
+        [str(address) for address, _ in sdms[1].hard_locations]
+    return covered and same
+
+
+def test_memory_budget(sdm_name, memory_budget, addresses_n):
+    """
+    Returns True if write_many/read_many with a small memory_budget give the same result as with one chunk, and
+    the peak memory they trace stays within 1.5 times the budget
+    """
+    def create_sdm():
+        if sdm_name == 'PackedBinarySDM':
+            return PackedBinarySDM(1024, 8, 2000, 480, hard_location_creation=HardLocationCreation.Random, seed=1)
+        return ArrayArithmeticSDM(32, 8, 2000, 1000, hard_location_creation=HardLocationCreation.Random, seed=1)
+
+    sdms      = [create_sdm(), create_sdm()]
+    addresses = [sdms[0].create_random_address().value for _ in range(addresses_n)]
+    contents  = [address[:8] for address in addresses]
+    sdms[0].memory_budget = 2 ** 40
+    sdms[1].memory_budget = memory_budget
+    sdms[0].write_many(addresses, contents)
+    tracemalloc.start()
+    try:
+        sdms[1].write_many(addresses, contents)
+        values  = sdms[1].read_many(addresses)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return values == sdms[0].read_many(addresses) and peak <= 1.5 * memory_budget
+
+
+def test_calibrate_memory_budget(sdm_name, memory_budget, probes):
+    """
+    Returns True if calibrate_radius with a small memory_budget gives the same radius as with one chunk of probes,
+    and the peak memory it traces stays within 1.5 times the budget
+    """
+    def create_sdm():
+        if sdm_name == 'PackedBinarySDM':
+            return PackedBinarySDM(1024, 8, 2000, 0, hard_location_creation=HardLocationCreation.Random, seed=1)
+        return ArrayArithmeticSDM(1024, 8, 2000, 0, hard_location_creation=HardLocationCreation.Random, seed=1)
+
+    sdms = [create_sdm(), create_sdm()]
+    sdms[0].memory_budget = 2 ** 40
+    sdms[1].memory_budget = memory_budget
+    radius = sdms[0].calibrate_radius(target_fraction=0.01, probes=probes)
+    tracemalloc.start()
+    try:
+        same    = sdms[1].calibrate_radius(target_fraction=0.01, probes=probes) == radius
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return same and peak <= 1.5 * memory_budget
+
+
+def test_sampled_seed(seed):
+    """
+    Returns True if two SDMs with the same seed read the same hard locations in Sampled read mode
+    """
+    sdms = [PackedBinarySDM(32, 8, 400, 12, hard_location_creation=HardLocationCreation.Random, seed=seed)
+            for _ in range(2)]
+    for sdm in sdms:
+        sdm.set_read_mode(ReadMode.Sampled, 3)
+    digits    = create_random_digits(20, 32, 2, np.random.default_rng(seed))
+    addresses = [BinaryAddress.create_from_digits(row).value for row in digits]
+    return all(np.array_equal(sdms[0].get_read_indexes(address), sdms[1].get_read_indexes(address))
+               for address in addresses)
+
+
+def test_random_address_seed(sdm_name, seed):
+    """
+    Returns True if two SDMs with the same seed create the same random addresses
+    """
+    sdm_class = globals()[sdm_name]
+    sdms      = [sdm_class(16, 8, 10, 4, seed=seed) for _ in range(2)]
+    return all(sdms[0].create_random_address().value == sdms[1].create_random_address().value for _ in range(10))
+
+
+def test_multi_index_near(address_length, number_of_hard_locations, radius, writes_n):
+    """
+    Returns True if the near hard locations found with the multi index are the same as with a linear scan, while
+    hard locations are created and deleted on demand
+    """
+    sdm = PackedBinarySDM(address_length, 8, number_of_hard_locations, radius,
+                          hard_location_creation=HardLocationCreation.OnDemand, multi_index=True)
+    for _ in range(writes_n):
+        address = sdm.create_random_address().value
+        sdm.write(address, '10101010')
+        for probe in [address, sdm.create_random_address().value]:
+            expected = np.flatnonzero((sdm.get_distances(probe) <= radius) & sdm.store.occupied[:sdm.store.end])
+            if not np.array_equal(sdm.get_near_indexes(probe, radius), expected):
+                return False
+    return True
+
+
+def test_metric_index_near(address_length, number_of_hard_locations, radius, writes_n):
+    """
+    Returns True if reads with the metric index are the same as with a linear scan, while hard locations are
+    created and deleted on demand
+    """
+    sdm = ArrayArithmeticSDM(address_length, address_length, number_of_hard_locations, radius,
+                             hard_location_creation=HardLocationCreation.OnDemand, metric_index=True)
+    for _ in range(writes_n):
+        address = sdm.create_random_address().value
+        sdm.write(address, address)
+        for probe in [address, sdm.create_random_address().value]:
+            sdm.use_index = True
+            with_index    = sdm.get_near_indexes(probe, radius)
+            sdm.use_index = False
+            if not np.array_equal(with_index, sdm.get_near_indexes(probe, radius)):
+                return False
+    return True
+
+
+def sdm_write_read(sdm, hard_locations, writes, reads, debug):
+    sdm.hard_locations = [create_hard_location(sdm.address_class(address), sdm.content_length)
                           for address in hard_locations]
     for [address, content] in writes:
         sdm.write(address, content)
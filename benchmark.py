@@ -0,0 +1,263 @@
+import inspect
+import itertools
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import SDM
+import unit_test as ut
+import yaml_functions as yf
+
+k_benchmarks     = 'benchmarks'
+k_benchmark      = 'benchmark'
+k_seed           = 'seed'
+k_operations     = 'operations'
+k_sweep          = ['number_of_hard_locations', 'address_length', 'radius_fraction', 'batch_size']
+k_sdm_parameters = ['content_length', 'hard_location_creation', 'learning_rate', 'values_per_dimension',
+                    'counter_type']
+
+default_config_file  = 'benchmark.yaml'
+default_results_file = 'benchmark_results.json'
+default_memory_limit = 512 * 2 ** 20  # bytes a benchmark case may need for its batch arrays
+
+
+def run_benchmarks(config_file=default_config_file, results_file=default_results_file, verbose=True):
+    """
+    Runs every benchmark of config_file for all the combinations of its sweep values and saves the results as
+    json in results_file, so runs can be compared
+    :param config_file: yaml with the benchmarks (see benchmark.yaml)
+    :param results_file:
+    :param verbose:
+    :return: the results
+    """
+    config  = yf.get_yaml_file(config_file, directory=None)
+    results = {'environment': get_environment(), 'config': config, 'results': []}
+    for benchmark_item in config[k_benchmarks]:
+        benchmark = benchmark_item[k_benchmark]
+        for case in get_cases(benchmark):
+            result = run_case(case, config.get(k_operations, 1000), config.get(k_seed, 0))
+            results['results'].append(result)
+            if verbose:
+                print('%s %s' % (case['name'], format_result(result)))
+    if results_file is not None:
+        yf.save_json_file(results, results_file, directory=None)
+    return results
+
+
+def get_cases(benchmark):
+    """
+    Returns one case (dict) for each combination of the sweep values of benchmark
+    :param benchmark:
+    :return:
+    """
+    values = [benchmark[name] if isinstance(benchmark[name], list) else [benchmark[name]] for name in k_sweep]
+    cases  = []
+    for combination in itertools.product(*values):
+        case = {name: value for name, value in benchmark.items() if name not in k_sweep}
+        case.update(zip(k_sweep, combination))
+        cases.append(case)
+    return cases
+
+
+def create_sdm(case, seed):
+    """
+    Returns the SDM of a case, radius is radius_fraction of the maximum distance between two addresses
+    :param case:
+    :param seed:
+    :return:
+    """
+    sdm_class  = getattr(SDM, case['class'])
+    parameters = {name: case[name] for name in k_sdm_parameters if name in case}
+    accepted   = inspect.signature(sdm_class.__init__).parameters
+    if 'seed' in accepted:
+        parameters['seed'] = seed
+    values_per_dimension = parameters.get('values_per_dimension', 2 if 'Binary' in case['class'] else 255)
+    radius = int(case['radius_fraction'] * case['address_length'] * (values_per_dimension - 1))
+    return sdm_class(case['address_length'], parameters.pop('content_length'), case['number_of_hard_locations'],
+                     radius, **parameters)
+
+
+def create_operations(sdm, n, seed):
+    """
+    Returns n random addresses and contents in the format expected by write/read
+    :param sdm:
+    :param n:
+    :param seed:
+    :return:
+    """
+    rng     = np.random.default_rng(seed)
+    lengths = [sdm.address_length, sdm.content_length]
+    digits  = [SDM.create_random_digits(n, length, sdm.values_per_dimensions, rng) for length in lengths]
+    values  = [[address_class.create_from_digits(row).value for row in rows]
+               for address_class, rows in zip([sdm.address_class, sdm.content_class], digits)]
+    return values[0], values[1]
+
+
+def run_case(case, operations, seed):
+    """
+    Returns the result of a benchmark case: time to build the SDM, ops/sec and latency percentiles of writes and
+    reads (one call per batch_size operations) and peak memory traced while building it and running a batch
+    :param case:
+    :param operations: number of writes (and reads)
+    :param seed:
+    :return:
+    """
+    start = time.perf_counter()
+    sdm   = create_sdm(case, seed)
+    build = time.perf_counter() - start
+    batch = case['batch_size']
+    addresses, contents = create_operations(sdm, operations, seed)
+
+    def write(start, end):
+        if batch == 1:
+            sdm.write(addresses[start], contents[start])
+        else:
+            sdm.write_many(addresses[start:end], contents[start:end])
+
+    def read(start, end):
+        if batch == 1:
+            sdm.read(addresses[start])
+        else:
+            sdm.read_many(addresses[start:end])
+
+    result = {name: value for name, value in case.items()}
+    result.update({'radius':        sdm.radius,
+                   'operations':    operations,
+                   'build_seconds': build,
+                   'write':         measure(write, operations, batch),
+                   'read':          measure(read, operations, batch),
+                   'peak_memory':   measure_peak_memory(case, seed, addresses, contents)})
+    return result
+
+
+def measure(operation, operations, batch_size):
+    """
+    Calls operation(start, end) for each batch and returns the throughput and latency (of each call) statistics
+    :param operation:
+    :param operations:
+    :param batch_size:
+    :return:
+    """
+    latencies = []
+    for start, end in SDM.get_chunks(operations, batch_size):
+        begin = time.perf_counter()
+        operation(start, end)
+        latencies.append(time.perf_counter() - begin)
+    latencies = np.array(latencies)
+    return {'ops_per_sec': operations / latencies.sum() if latencies.sum() > 0 else 0.0,
+            'p50_ms':      float(np.percentile(latencies, 50) * 1000),
+            'p99_ms':      float(np.percentile(latencies, 99) * 1000)}
+
+
+def measure_peak_memory(case, seed, addresses, contents):
+    """
+    Returns the peak bytes allocated (traced by tracemalloc, numpy arrays included) building the SDM of case and
+    writing/reading one batch. It is a separate run because tracing slows down the timed one
+    :param case:
+    :param seed:
+    :param addresses:
+    :param contents:
+    :return:
+    """
+    batch = case['batch_size']
+    tracemalloc.start()
+    try:
+        sdm = create_sdm(case, seed)
+        sdm.write_many(addresses[:batch], contents[:batch])
+        sdm.read_many(addresses[:batch])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def estimate_batch_memory(sdm, batch_size):
+    """
+    Returns the estimated bytes of the arrays write_many/read_many build at once for a batch of batch_size: one
+    chunk of (address, hard location) pairs. It is 0 for the SDMs that are not ArraySDM, they write and read one
+    address at a time through Address objects without such arrays
+    :param sdm:
+    :param batch_size:
+    :return:
+    """
+    if not isinstance(sdm, SDM.ArraySDM):
+        return 0
+    return sdm.get_chunk_size(batch_size) * max(1, sdm.store.end) * sdm.get_pair_bytes()
+
+
+def check_config(config_file=default_config_file, memory_limit=default_memory_limit):
+    """
+    Returns the name and sweep values of the cases of config_file whose batch arrays (see estimate_batch_memory)
+    would need more than memory_limit bytes
+    :param config_file:
+    :param memory_limit:
+    :return:
+    """
+    config = yf.get_yaml_file(config_file, directory=None)
+    failed = []
+    for benchmark_item in config[k_benchmarks]:
+        for case in get_cases(benchmark_item[k_benchmark]):
+            sdm = create_sdm(case, config.get(k_seed, 0))
+            if estimate_batch_memory(sdm, case['batch_size']) > memory_limit:
+                failed.append([case['name']] + [case[name] for name in k_sweep])
+    return failed
+
+
+def get_environment():
+    return {'python':    platform.python_version(),
+            'numpy':     np.__version__,
+            'platform':  platform.platform(),
+            'processor': platform.processor(),
+            'time':      time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def format_result(result):
+    return 'N:%s L:%s r:%s batch:%s | write %.0f ops/s p99 %.3f ms | read %.0f ops/s p99 %.3f ms | %.1f MB' % \
+           (result['number_of_hard_locations'], result['address_length'], result['radius'], result['batch_size'],
+            result['write']['ops_per_sec'], result['write']['p99_ms'], result['read']['ops_per_sec'],
+            result['read']['p99_ms'], result['peak_memory'] / 2 ** 20)
+
+
+# Tests
+def test_run_case(sdm_class, hard_location_creation, batch_size):
+    """
+    Returns the keys of the result of a small case and if all the measures are positive
+    """
+    case = {'name': 'test', 'class': sdm_class, 'hard_location_creation': hard_location_creation,
+            'content_length': 8, 'number_of_hard_locations': 200, 'address_length': 16, 'radius_fraction': 0.3,
+            'batch_size': batch_size}
+    result   = run_case(case, 50, 1)
+    measures = [result[kind][name] for kind in ['write', 'read'] for name in ['ops_per_sec', 'p50_ms', 'p99_ms']]
+    return [sorted(result['write'].keys()), all(measure > 0 for measure in measures), result['peak_memory'] > 0]
+
+
+def test_get_cases(number_of_hard_locations, address_length, radius_fraction, batch_size):
+    benchmark = {'name': 'test', 'class': 'PackedBinarySDM', 'number_of_hard_locations': number_of_hard_locations,
+                 'address_length': address_length, 'radius_fraction': radius_fraction, 'batch_size': batch_size}
+    return len(get_cases(benchmark))
+
+
+def test_estimate_batch_memory(sdm_class, batch_size):
+    """
+    Returns the estimated batch memory of a small SDM of sdm_class
+    """
+    case = {'name': 'test', 'class': sdm_class, 'hard_location_creation': 1, 'content_length': 8,
+            'number_of_hard_locations': 100, 'address_length': 16, 'radius_fraction': 0.3, 'batch_size': batch_size}
+    return estimate_batch_memory(create_sdm(case, 1), batch_size)
+
+
+def test_check_config(config_file, memory_limit):
+    """
+    Returns the cases of config_file that would not fit in memory_limit
+    """
+    return check_config(config_file, memory_limit)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        # python benchmark.py run [config file] [results file]
+        run_benchmarks(*sys.argv[2:4])
+    else:
+        ut.UnitTest(__name__, 'tests/benchmark.test', '')
@@ -1,6 +1,18 @@
+import functools
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import os
+import sys
+import tempfile
 from PIL import Image
 
 import SDM
+import unit_test as ut
+import yaml_functions as yf
+
+k_cache_index_file = 'index.json'
+k_cache_data_file  = 'images-%s.npy'  # one file per generation of the cache
 
 
 class ImageSDM:
@@ -10,14 +22,15 @@ class ImageSDM:
         address_len = h * w
         content_len = address_len
 
-        self.sdm = SDM.ArithmeticSDM(address_len, content_len, number_of_hard_locations, radius,
-                                     learning_rate=learning_rate,
-                                     hard_location_creation=SDM.HardLocationCreation.OnDemand)
-        for image in self.images.images:
-            self.sdm.write(image, image)
+        self.size = (h, w)
+        self.sdm  = SDM.ArrayArithmeticSDM(address_len, content_len, number_of_hard_locations, radius,
+                                           learning_rate=learning_rate,
+                                           hard_location_creation=SDM.HardLocationCreation.OnDemand)
+        self.sdm.fit_stream((pixels, pixels) for pixels in map(image_to_array, self.images.images))
 
     def read(self, image):
-        return self.sdm.read(image)
+        values = self.sdm.read(image_to_array(image))
+        return Image.fromarray(np.array(values, dtype=np.uint8).reshape(self.size))
 
 
 class Images:
@@ -28,22 +41,48 @@ class Images:
         self.images = []
         self.names  = []
 
-    def load_from_files(self, file_names):
-        for file_name in file_names:
-            self.images.append(open_image(file_name))
-            self.names.append(file_name)
+    def load_from_files(self, file_names, n_processes=None):
+        """
+        :param file_names:
+        :param n_processes: if set, files are decoded in parallel by a pool of n_processes processes
+        :return:
+        """
+        self.images.extend(map_images(load_image, file_names, n_processes))
+        self.names.extend(file_names)
+
+    def load_normalized(self, file_names, inc=30, min_gray=20, cache_path=None, n_processes=None):
+        """
+        Same as load_from_files and normalize_images, but if cache_path is set the centered images are kept in an
+        ImageCache there, so only new or changed files are decoded again
+        :param file_names:
+        :param inc:
+        :param min_gray:
+        :param cache_path: directory of the cache
+        :param n_processes: if set, files are decoded and centered in parallel by a pool of n_processes processes
+        :return:
+        """
+        if cache_path is None:
+            centered = map_images(functools.partial(load_centered_image, inc=inc, min_gray=min_gray), file_names,
+                                  n_processes)
+        else:
+            centered = ImageCache(cache_path).get_centered_images(file_names, inc=inc, min_gray=min_gray,
+                                                                  n_processes=n_processes)
+        self.images.extend(centered)
+        self.names.extend(file_names)
+        self.force_equal_size()
 
     def image_size(self):
         return [self.images[0].height, self.images[0].width] if len(self.images) > 0 else [0, 0]
 
-    def normalize_images(self, inc=30, min_gray=20):
+    def normalize_images(self, inc=30, min_gray=20, n_processes=None):
         """
         In order to be stored in an SDM a normalization process is needed to assure all images have the same size
         :param inc:
         :param min_gray:
+        :param n_processes: if set, images are centered in parallel by a pool of n_processes processes
         :return:
         """
-        self.center( inc=inc, min_gray=min_gray)
+        self.center(inc=inc, min_gray=min_gray, n_processes=n_processes)
         self.force_equal_size()
 
     def force_equal_size(self):
@@ -58,27 +97,16 @@ class Images:
                    int(image.width / 2 + max_width / 2), int(image.height / 2 + max_height / 2))
             self.images[i] = image.crop(box=box)
 
-    def center(self, inc=30, min_gray=20):
+    def center(self, inc=30, min_gray=20, n_processes=None):
         """
         Crop each image taking out all white pixel in the surroundings
         :param inc: pixels to add around
         :param min_gray: any gray value less than this is considered white
+        :param n_processes: if set, images are centered in parallel by a pool of n_processes processes
         :return:
         """
-        for i, image in enumerate(self.images):
-            min_width  = image.width
-            max_width  = 0
-            min_height = image.height
-            max_height = 0
-            for x in range(image.width):
-                for y in range(image.height):
-                    if image.getpixel((x, y)) > min_gray:
-                        continue
-                    min_width  = min(x, min_width)
-                    max_width  = max(x, max_width)
-                    min_height = min(y, min_height)
-                    max_height = max(y, max_height)
-            self.images[i] = image.crop(box=(min_width-inc, min_height-inc, max_width+inc, max_height+inc))
+        self.images = map_images(functools.partial(center_image, inc=inc, min_gray=min_gray), self.images,
+                                 n_processes)
 
     def show(self):
         for image in self.images:
@@ -89,26 +117,326 @@ class Images:
             print('   %s: %s' % (self.names[i], image.size))
 
 
+def center_image(image, inc=30, min_gray=20):
+    """
+    Returns image cropped to the box of its ink (see get_ink_box)
+    :param image:
+    :param inc:
+    :param min_gray:
+    :return:
+    """
+    return image.crop(box=get_ink_box(image, inc=inc, min_gray=min_gray))
+
+
+def get_ink_box(image, inc=30, min_gray=20):
+    """
+    Returns the box (left, upper, right, lower) around the pixels not lighter than min_gray plus inc pixels on each
+    side, found with reductions over the pixels as an array. Without such pixels it is the same inverted box the
+    pixel by pixel search gave
+    :param image:
+    :param inc:
+    :param min_gray:
+    :return:
+    """
+    ink     = np.asarray(image) <= min_gray
+    columns = np.flatnonzero(ink.any(axis=0))
+    rows    = np.flatnonzero(ink.any(axis=1))
+    if len(columns) == 0:
+        return image.width - inc, image.height - inc, inc, inc
+    return int(columns[0]) - inc, int(rows[0]) - inc, int(columns[-1]) + inc, int(rows[-1]) + inc
+
+
+def map_images(function, items, n_processes=None):
+    """
+    Returns [function(item) for item in items], computed by a pool of n_processes processes if it is set
+    :param function: must be picklable (a module function or a functools.partial of one)
+    :param items:
+    :param n_processes:
+    :return:
+    """
+    if not n_processes or len(items) < 2:
+        return [function(item) for item in items]
+    with mp.Pool(min(n_processes, len(items))) as pool:
+        return pool.map(function, items)
+
+
+def load_image(image_path):
+    """
+    Returns the image in image_path already decoded (so it is done by the process that loads it)
+    :param image_path:
+    :return:
+    """
+    image = open_image(image_path)
+    image.load()
+    return image
+
+
+class ImageCache:
+    """
+    Keeps the centered images (see Images.center) of many files in one contiguous .npy file, memory mapped when
+    read, with a json index of where each one is. Entries are keyed by file path and centering parameters, and
+    are valid while the file has the same modification time and size, or else the same content hash, so only the
+    files changed are decoded again.
+    Each update writes a new data file and then the index naming it, both aside and renamed, so an interrupted
+    update leaves the previous cache
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory of the cache files (created if needed)
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = yf.get_json_file(k_cache_index_file, directory=path, must_exist=False)
+        if not self.index or self.index.get('data') is None:
+            self.index = {'entries': {}, 'data': None, 'generation': 0}
+        self.stats   = {'hits': 0, 'misses': 0}
+        self.touched = False  # entries of files touched but not changed, to save in the index
+
+    def get_centered_images(self, file_names, inc=30, min_gray=20, n_processes=None):
+        """
+        Returns the centered images of file_names, from the cache when valid and loading the others (which are
+        then added to the cache)
+        :param file_names:
+        :param inc:
+        :param min_gray:
+        :param n_processes: if set, files not cached are loaded by a pool of n_processes processes
+        :return:
+        """
+        keys    = [get_cache_key(file_name, inc, min_gray) for file_name in file_names]
+        missing = [i for i, (key, file_name) in enumerate(zip(keys, file_names)) if not self.is_valid(key, file_name)]
+        self.stats['hits']   += len(file_names) - len(missing)
+        self.stats['misses'] += len(missing)
+        if missing:
+            loaded = map_images(functools.partial(load_centered_image, inc=inc, min_gray=min_gray),
+                                [file_names[i] for i in missing], n_processes)
+            self.update({keys[i]: (file_names[i], image) for i, image in zip(missing, loaded)})
+        elif self.touched:
+            self.save_index()
+        self.touched = False
+        data = self.get_data()
+        return [Image.fromarray(self.get_array(data, self.index['entries'][key])) for key in keys]
+
+    def is_valid(self, key, file_name):
+        """
+        Returns True if the entry of key was created from the current content of file_name
+        :param key:
+        :param file_name:
+        :return:
+        """
+        entry = self.index['entries'].get(key)
+        if entry is None:
+            return False
+        status = os.stat(file_name)
+        if entry['mtime'] == status.st_mtime_ns and entry['size'] == status.st_size:
+            return True
+        if entry['hash'] != get_file_hash(file_name):
+            return False
+        # touched but not changed
+        entry['mtime'] = status.st_mtime_ns
+        entry['size']  = status.st_size
+        self.touched   = True
+        return True
+
+    def update(self, images):
+        """
+        Writes the cache again with the entries kept (still valid or not requested, and whose file still exists)
+        and images
+        :param images: dictionary key -> (file name, centered image) of the entries to add or replace
+        :return:
+        """
+        data    = self.get_data()
+        kept    = {key: entry for key, entry in self.index['entries'].items()
+                   if key not in images and os.path.exists(entry['file'])}
+        arrays  = [self.get_array(data, entry) for entry in kept.values()]
+        entries = list(kept.items())
+        for key, (file_name, image) in images.items():
+            status = os.stat(file_name)
+            arrays.append(np.asarray(image))
+            entries.append((key, {'file': os.path.abspath(file_name), 'mtime': status.st_mtime_ns,
+                                  'size': status.st_size, 'hash': get_file_hash(file_name)}))
+        offset = 0
+        for (_, entry), array in zip(entries, arrays):
+            entry.update({'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str})
+            offset += array.nbytes
+        buffer = np.concatenate([np.ascontiguousarray(array).view(np.uint8).ravel() for array in arrays]) \
+            if arrays else np.zeros(0, dtype=np.uint8)
+        # a new data file, the old one (maybe memory mapped) is only removed once the index no longer names it
+        old_data   = self.index['data']
+        generation = self.index['generation'] + 1
+        data_file  = k_cache_data_file % generation
+        np.save(os.path.join(self.path, data_file + '.tmp.npy'), buffer)
+        os.replace(os.path.join(self.path, data_file + '.tmp.npy'), os.path.join(self.path, data_file))
+        self.index = {'entries': dict(entries), 'data': data_file, 'generation': generation}
+        self.save_index()
+        if old_data is not None and old_data != data_file:
+            try:
+                os.remove(os.path.join(self.path, old_data))
+            except OSError:
+                pass
+
+    def save_index(self):
+        """
+        Saves the index aside and renames it, so readers see the old or the new one
+        :return:
+        """
+        yf.save_json_file(self.index, k_cache_index_file + '.tmp', directory=self.path)
+        os.replace(os.path.join(self.path, k_cache_index_file + '.tmp'), os.path.join(self.path, k_cache_index_file))
+
+    def get_data(self):
+        """
+        Returns the data of all the cached images (a memory mapped uint8 vector)
+        :return:
+        """
+        if self.index['data'] is None:
+            return np.zeros(0, dtype=np.uint8)
+        return np.load(os.path.join(self.path, self.index['data']), mmap_mode='r')
+
+    @staticmethod
+    def get_array(data, entry):
+        size = int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize
+        return data[entry['offset']:entry['offset'] + size].view(np.dtype(entry['dtype'])).reshape(entry['shape'])
+
+    def clear(self):
+        self.index['entries'] = {}
+        self.update({})
+
+
+def get_cache_key(file_name, inc, min_gray):
+    return '%s|%s|%s' % (os.path.abspath(file_name), inc, min_gray)
+
+
+def get_file_hash(file_name):
+    with open(file_name, 'rb') as image_file:
+        return hashlib.sha1(image_file.read()).hexdigest()
+
+
+def load_centered_image(image_path, inc=30, min_gray=20):
+    return center_image(load_image(image_path), inc=inc, min_gray=min_gray)
+
+
 def open_images(image_list):
     return [Image.open(name) for name in image_list]
 
 
+def image_to_array(image):
+    """
+    Returns the gray levels of image as a flat vector, to be used as address or content of an SDM
+    :param image:
+    :return:
+    """
+    return np.asarray(image.convert('L'), dtype=np.int16).ravel()
+
+
 def open_image(image_path):
     image = Image.open(image_path)
     return image
 
 
-if __name__ == "__main__":
-    images = Images()
-    letters     = ['A', 'B', 'C', 'D', 'E', 'F']
-    image_list1 = ['Samples/Letters/letter%s.pgm' % letter for letter in letters]
-    images.load_from_files(image_list1)
-    images.normalize_images()
-    # images.show()
-    # images.print()
-    sdm = ImageSDM(images)
-    image_read = sdm.read(images.images[0])
-    image_read.show()
+# Tests
+def get_ink_box_by_pixels(image, inc=30, min_gray=20):
+    """
+    Reference of get_ink_box: pixel by pixel search of the box
+    """
+    min_width  = image.width
+    max_width  = 0
+    min_height = image.height
+    max_height = 0
+    for x in range(image.width):
+        for y in range(image.height):
+            if image.getpixel((x, y)) > min_gray:
+                continue
+            min_width  = min(x, min_width)
+            max_width  = max(x, max_width)
+            min_height = min(y, min_height)
+            max_height = max(y, max_height)
+    return min_width - inc, min_height - inc, max_width + inc, max_height + inc
 
 
+def create_test_images(images_n, seed):
+    """
+    Returns images_n white gray images with a random dark rectangle (its first pixel black)
+    """
+    rng    = np.random.default_rng(seed)
+    images = []
+    for _ in range(images_n):
+        height, width = rng.integers(5, 40, 2)
+        top, left     = rng.integers(0, height), rng.integers(0, width)
+        bottom, right = rng.integers(top, height) + 1, rng.integers(left, width) + 1
+        pixels        = np.full((height, width), 255, dtype=np.uint8)
+        pixels[top:bottom, left:right] = rng.integers(0, 60, (bottom - top, right - left))
+        pixels[top, left]              = 0
+        images.append(Image.fromarray(pixels))
+    return images
 
+
+def test_center(images_n, inc, min_gray, n_processes):
+    """
+    Returns True if get_ink_box gives the box of the pixel by pixel search (also for a blank image) and
+    Images.center crops every image to it, with and without a pool of processes
+    """
+    images        = Images()
+    images.images = create_test_images(images_n, 1)
+    boxes         = [get_ink_box_by_pixels(image, inc=inc, min_gray=min_gray) for image in images.images]
+    blank         = Image.new('L', (10, 7), 255)
+    same_boxes    = [get_ink_box(image, inc=inc, min_gray=min_gray) for image in images.images + [blank]] == \
+        boxes + [get_ink_box_by_pixels(blank, inc=inc, min_gray=min_gray)]
+    crops         = [image.crop(box=box) for image, box in zip(images.images, boxes)]
+    images.center(inc=inc, min_gray=min_gray, n_processes=n_processes)
+    return same_boxes and all(np.array_equal(np.asarray(image), np.asarray(crop))
+                              for image, crop in zip(images.images, crops))
+
+
+def test_image_cache(images_n, inc, min_gray):
+    """
+    Loads images_n generated image files through an ImageCache (a new one each time, as another run would) and
+    returns the [hits, misses] of each load: the first one, again, after touching a file without changing it,
+    after changing a file, and after deleting a file and loading the others with other centering parameters.
+    Then if the touched file got its new modification time in the index, if the images loaded are the ones centered
+    without cache, the number of entries and of data files
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = [os.path.join(directory, 'image%s.png' % i) for i in range(images_n)]
+        for image, file_name in zip(create_test_images(images_n, 1), file_names):
+            image.save(file_name)
+        cache_path = os.path.join(directory, 'cache')
+        stats      = []
+
+        def load(names, inc_used):
+            cache  = ImageCache(cache_path)
+            loaded = cache.get_centered_images(names, inc=inc_used, min_gray=min_gray)
+            stats.append([cache.stats['hits'], cache.stats['misses']])
+            return loaded
+
+        load(file_names, inc)
+        load(file_names, inc)
+        status = os.stat(file_names[0])
+        os.utime(file_names[0], ns=(status.st_atime_ns, status.st_mtime_ns + 10 ** 9))
+        load(file_names, inc)
+        touched = ImageCache(cache_path).index['entries'][get_cache_key(file_names[0], inc, min_gray)]['mtime'] == \
+            os.stat(file_names[0]).st_mtime_ns
+        create_test_images(1, 2)[0].save(file_names[1])
+        loaded = load(file_names, inc)
+        same   = all(np.array_equal(np.asarray(image), np.asarray(load_centered_image(file_name, inc, min_gray)))
+                     for image, file_name in zip(loaded, file_names))
+        os.remove(file_names[-1])
+        load(file_names[:-1], inc + 1)
+        entries = len(ImageCache(cache_path).index['entries'])
+        data    = [name for name in os.listdir(cache_path) if name.endswith('.npy')]
+        return stats + [touched, same, entries, len(data)]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'demo':
+        # python images.py demo
+        images = Images()
+        letters     = ['A', 'B', 'C', 'D', 'E', 'F']
+        image_list1 = ['Samples/Letters/letter%s.pgm' % letter for letter in letters]
+        images.load_normalized(image_list1, cache_path='.image_cache')
+        # images.show()
+        # images.print()
+        sdm = ImageSDM(images)
+        image_read = sdm.read(images.images[0])
+        image_read.show()
+    else:
+        ut.UnitTest(__name__, 'tests/images.test', '')
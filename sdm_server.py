@@ -0,0 +1,363 @@
+import asyncio
+import itertools
+import numpy as np
+import os
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import SDM
+import unit_test as ut
+
+# Protocol: every message is a frame with a 4 bytes big endian length followed by that many bytes.
+# Request payload:  opcode (1 byte) + address (+ content for writes), values as big endian int16 vectors
+# Response payload: status (1 byte) + content for reads (or an utf-8 error message if status is k_error)
+k_read  = 1
+k_write = 2
+k_ok    = 0
+k_error = 1
+
+k_local_hosts = ['127.0.0.1', 'localhost', '::1']
+k_value_dtype = np.dtype('>i2')
+
+default_batch_window   = 0.001  # seconds waiting for more requests after the first one of a batch
+default_max_batch_size = 1024
+
+
+class SDMServer(object):
+    """
+    Serves read/write of an SDM over a local socket (TCP or Unix). Requests arriving from all the connections within
+    batch_window are executed as one batch (write_many/read_many) in arrival order: consecutive reads (or writes) are
+    grouped, so a read always sees the writes received before it
+    """
+
+    def __init__(self, sdm, batch_window=default_batch_window, max_batch_size=default_max_batch_size):
+        """
+        :param sdm: SDM to serve
+        :param batch_window: seconds to wait for more requests once the first one of a batch arrives
+        :param max_batch_size: maximum number of requests executed in one batch
+        """
+        if getattr(sdm, 'float_content', False):
+            raise Exception('SDMServer sends int16 values, SDMs with float_content can not be served')
+        self.sdm            = sdm
+        self.batch_window   = batch_window
+        self.max_batch_size = max_batch_size
+        self.queue          = None
+        self.server         = None
+        self.batcher        = None
+        self.executor       = ThreadPoolExecutor(max_workers=1)  # the SDM is used by one batch at a time
+        self.stats          = {}
+        self.reset_stats()
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """
+        Starts listening in host:port (port 0 takes a free one, see get_address) or in Unix socket path
+        :param host: only local hosts are accepted
+        :param port:
+        :param path: if set a Unix socket is used instead of TCP
+        :return:
+        """
+        if path is None and host not in k_local_hosts:
+            raise Exception('SDMServer only listens on local hosts, not in %s' % host)
+        self.queue   = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.run_batches())
+        if path is None:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        else:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    def get_address(self):
+        """
+        Returns the (host, port) or path the server listens on
+        :return:
+        """
+        return self.server.sockets[0].getsockname()
+
+    def get_stats(self):
+        """
+        Returns the requests served, batches executed, current and maximum queue depth and batch sizes
+        :return:
+        """
+        stats = dict(self.stats)
+        stats['queue_depth']     = self.queue.qsize() if self.queue is not None else 0
+        stats['mean_batch_size'] = stats['requests'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'batches': 0, 'max_batch_size': 0, 'max_queue_depth': 0}
+
+    async def handle_connection(self, reader, writer):
+        """
+        Reads the requests of one connection and answers them in the same order
+        :param reader:
+        :param writer:
+        :return:
+        """
+        replies   = asyncio.Queue()
+        responder = asyncio.ensure_future(self.send_replies(replies, writer))
+        try:
+            while True:
+                payload = await read_frame(reader)
+                if payload is None:
+                    break
+                future = asyncio.get_running_loop().create_future()
+                try:
+                    request = self.decode_request(payload)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    await self.queue.put((request, future))
+                    self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue.qsize())
+                await replies.put(future)
+        finally:
+            await replies.put(None)
+            await responder
+            writer.close()
+
+    @staticmethod
+    async def send_replies(replies, writer):
+        while True:
+            future = await replies.get()
+            if future is None:
+                break
+            try:
+                value   = await future
+                payload = bytes([k_ok]) + (b'' if value is None else encode_value(value).tobytes())
+            except Exception as e:
+                payload = bytes([k_error]) + str(e).encode('utf-8')
+            try:
+                writer.write(struct.pack('!I', len(payload)) + payload)
+                await writer.drain()
+            except ConnectionError:
+                break
+
+    def decode_request(self, payload):
+        """
+        Returns (opcode, address, content) from the payload of a request
+        :param payload:
+        :return:
+        """
+        opcode = payload[0]
+        values = np.frombuffer(payload, dtype=k_value_dtype, offset=1)
+        if opcode == k_read and len(values) == self.sdm.address_length:
+            return opcode, self.decode_value(values, self.sdm.address_class), None
+        if opcode == k_write and len(values) == self.sdm.address_length + self.sdm.content_length:
+            return opcode, self.decode_value(values[:self.sdm.address_length], self.sdm.address_class), \
+                self.decode_value(values[self.sdm.address_length:], self.sdm.content_class)
+        raise Exception('Invalid request (opcode %s with %s values)' % (opcode, len(values)))
+
+    @staticmethod
+    def decode_value(values, address_class):
+        """
+        Returns values as expected by the SDM: a binary string or a list of integers
+        :param values:
+        :param address_class:
+        :return:
+        """
+        return SDM.decode_values(values, address_class)
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.stats['requests']      += len(batch)
+            self.stats['batches']       += 1
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+            results = await loop.run_in_executor(self.executor, self.execute, [request for request, _ in batch])
+            for (_, future), (error, value) in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if error is None:
+                    future.set_result(value)
+                else:
+                    future.set_exception(error)
+
+    def execute(self, requests):
+        """
+        Executes a batch of requests in order, consecutive requests of the same kind in one call
+        :param requests: list of (opcode, address, content)
+        :return: a list of (error, value) with the result of each request
+        """
+        results = []
+        for opcode, group in itertools.groupby(requests, key=lambda request: request[0]):
+            group     = list(group)
+            addresses = [address for _, address, _ in group]
+            try:
+                if opcode == k_read:
+                    values = self.sdm.read_many(addresses)
+                else:
+                    self.sdm.write_many(addresses, [content for _, _, content in group])
+                    values = [None] * len(group)
+                results.extend((None, value) for value in values)
+            except Exception as e:
+                results.extend((e, None) for _ in group)
+        return results
+
+
+class SDMClient(object):
+    """
+    Client of an SDMServer, one request at a time per connection (use many clients to send concurrent requests)
+    """
+
+    def __init__(self, reader, writer, binary=False):
+        self.reader = reader
+        self.writer = writer
+        self.binary = binary
+        self.lock   = asyncio.Lock()
+
+    @staticmethod
+    async def connect(host='127.0.0.1', port=None, path=None, binary=False):
+        """
+        Returns a client connected to the server in host:port or in Unix socket path
+        :param host:
+        :param port:
+        :param path:
+        :param binary: if True the contents read are returned as binary strings instead of lists of integers
+        :return:
+        """
+        if path is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        else:
+            reader, writer = await asyncio.open_unix_connection(path)
+        return SDMClient(reader, writer, binary=binary)
+
+    async def read(self, address):
+        values = await self.request(k_read, encode_value(address))
+        values = np.frombuffer(values, dtype=k_value_dtype)
+        return SDMServer.decode_value(values, SDM.BinaryAddress if self.binary else SDM.IntegersAddress)
+
+    async def write(self, address, content):
+        await self.request(k_write, np.concatenate([encode_value(address), encode_value(content)]))
+
+    async def request(self, opcode, values):
+        payload = bytes([opcode]) + values.astype(k_value_dtype).tobytes()
+        async with self.lock:
+            self.writer.write(struct.pack('!I', len(payload)) + payload)
+            await self.writer.drain()
+            reply = await read_frame(self.reader)
+        if reply is None:
+            raise Exception('Connection closed by the server')
+        if reply[0] != k_ok:
+            raise Exception(reply[1:].decode('utf-8'))
+        return reply[1:]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def read_frame(reader):
+    """
+    Returns the payload of the next frame, None if the connection was closed
+    :param reader:
+    :return:
+    """
+    try:
+        header  = await reader.readexactly(4)
+        payload = await reader.readexactly(struct.unpack('!I', header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return payload
+
+
+def encode_value(value):
+    """
+    Returns an address or content (binary string, list of integers or Address) as a vector to be sent
+    :param value:
+    :return:
+    """
+    value = value.value if isinstance(value, SDM.Address) else value
+    if isinstance(value, str):
+        value = [1 if bit == '1' else 0 for bit in value]
+    return np.asarray(value, dtype=k_value_dtype)
+
+
+def serve(sdm, host='127.0.0.1', port=0, path=None, batch_window=default_batch_window,
+          max_batch_size=default_max_batch_size):
+    """
+    Serves sdm until the process is interrupted
+    """
+    async def run():
+        server = SDMServer(sdm, batch_window=batch_window, max_batch_size=max_batch_size)
+        await server.start(host=host, port=port, path=path)
+        print('SDM server listening on %s' % (server.get_address(),))
+        await server.server.serve_forever()
+
+    asyncio.run(run())
+
+
+# Tests
+def test_server_read(sdm_name, clients_n, writes_n, unix_socket):
+    """
+    Returns True if concurrent reads through an SDMServer give the same values as reading a copy of the SDM
+    directly, and they were executed in batches
+    """
+    if sdm_name == 'BinarySDM':
+        sdms = [SDM.BinarySDM(24, 8, 200, 9) for _ in range(2)]
+        sdms[0].hard_locations = [SDM.create_hard_location(SDM.BinaryAddress(random_bits(24)), 8) for _ in range(200)]
+        addresses = [random_bits(24) for _ in range(writes_n)]
+        contents  = [random_bits(8) for _ in range(writes_n)]
+    else:
+        sdms = [SDM.ArrayArithmeticSDM(4, 4, 200, 150, hard_location_creation=SDM.HardLocationCreation.Random)
+                for _ in range(2)]
+        addresses = [sdms[0].create_random_address().value for _ in range(writes_n)]
+        contents  = [sdms[0].create_random_address().value for _ in range(writes_n)]
+    sdms[1].hard_locations = sdms[0].hard_locations
+    for address, content in zip(addresses, contents):
+        sdms[0].write(address, content)
+
+    async def run(directory):
+        server = SDMServer(sdms[1], batch_window=0.01)
+        path   = os.path.join(directory, 'sdm_server.sock') if unix_socket else None
+        await server.start(path=path)
+        port    = None if unix_socket else server.get_address()[1]
+        clients = [await SDMClient.connect(port=port, path=path, binary=sdm_name == 'BinarySDM')
+                   for _ in range(clients_n)]
+        for address, content in zip(addresses, contents):
+            await clients[0].write(address, content)
+
+        async def read_all(client):
+            return [await client.read(address) for address in addresses]
+
+        values = await asyncio.gather(*[read_all(client) for client in clients])
+        for client in clients:
+            await client.close()
+        stats = server.get_stats()
+        await server.stop()
+        return values, stats
+
+    with tempfile.TemporaryDirectory() as directory:
+        values, stats = asyncio.run(run(directory))
+    expected      = [sdms[0].read(address) for address in addresses]
+    return all(client_values == expected for client_values in values) and stats['max_batch_size'] > 1
+
+
+def test_float_content_rejected():
+    sdm = SDM.PackedBinarySDM(16, 4, 10, 4, float_content=True)
+    try:
+        SDMServer(sdm)
+    except Exception:
+        return True
+    return False
+
+
+def random_bits(n):
+    return ''.join(np.random.choice(['0', '1'], n))
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/sdm_server.test', '')
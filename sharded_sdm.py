@@ -0,0 +1,244 @@
+import multiprocessing as mp
+import numpy as np
+from multiprocessing import shared_memory
+
+import SDM
+import unit_test as ut
+
+k_ok    = 0
+k_error = 1
+
+k_join_timeout = 5  # seconds waiting for each worker to stop before terminating it
+
+
+class ShardedSDM(object):
+    """
+    Splits the hard locations of an SDM across a pool of worker processes, each one owning a shard kept in shared
+    memory. Writes are sent to every shard and reads add the partial counter sums (and number of near hard
+    locations) of all shards, so the result is the same as reading the original SDM but each shard is scanned in
+    its own core
+    """
+    replies = ['read_sums', 'read_many_sums']
+
+    def __init__(self, sdm, number_of_shards=None):
+        """
+        :param sdm: SDM with the hard locations to share (it is not modified, its hard locations are copied)
+        :param number_of_shards: number of worker processes (default: one per core)
+        """
+        if sdm.address_dtype == object:
+            raise Exception('Only SDMs with numeric addresses (ArraySDM) can be sharded')
+        if sdm.hard_locations_creation == SDM.HardLocationCreation.OnDemand:
+            raise Exception('ShardedSDM does not support hard locations created on demand')
+        if sdm.read_mode != SDM.ReadMode.Radius:
+            # the k hard locations read by each shard would be added up instead of the k of the whole SDM
+            raise Exception('ShardedSDM only supports the Radius read mode, not %s' % SDM.ReadMode(sdm.read_mode).name)
+        class_name       = type(sdm).__name__
+        parameters       = sdm.get_parameters()
+        self.template    = SDM.SDM.create_from_parameters(class_name, parameters)  # used to build the values read
+        number_of_shards = mp.cpu_count() if number_of_shards is None else number_of_shards
+
+        self.shared_memories = []
+        self.connections     = []
+        self.workers         = []
+        for slots in np.array_split(sdm.store.get_slots(), number_of_shards):
+            arrays = []
+            for array in [sdm.store.addresses[slots], sdm.store.counters[slots]]:
+                shm, spec = create_shared_array(array)
+                self.shared_memories.append(shm)
+                arrays.append(spec)
+            connection, worker_connection = mp.Pipe()
+            worker = mp.Process(target=run_shard, args=(worker_connection, class_name, parameters, arrays),
+                                daemon=True)
+            worker.start()
+            worker_connection.close()  # only the worker uses its end, so its death is seen as EOFError
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, address, content):
+        self.broadcast('write', address, content)
+
+    def write_many(self, addresses, contents, chunk_size=None):
+        self.broadcast('write_many', addresses, contents, chunk_size)
+
+    def read(self, address):
+        sums, total = self.gather(self.broadcast('read_sums', address))
+        return self.template.get_value_from_sums(sums, total)
+
+    def read_many(self, addresses, chunk_size=None):
+        return self.template.get_values_from_sums(*self.gather(self.broadcast('read_many_sums', addresses, chunk_size)))
+
+    def broadcast(self, command, *args):
+        """
+        Sends command to all shards, returns the answers if the command has one
+        :param command:
+        :param args:
+        :return:
+        """
+        for connection in self.connections:
+            connection.send((command, args))
+        if command not in self.replies:
+            return None
+        # all the replies are received (so the connections stay in sync) before raising the first error
+        replies = [connection.recv() for connection in self.connections]
+        for status, value in replies:
+            if status == k_error:
+                raise value
+        return [value for _, value in replies]
+
+    @staticmethod
+    def gather(partials):
+        sums   = sum(partial[0] for partial in partials)
+        totals = sum(partial[1] for partial in partials)
+        return sums, totals
+
+    def close(self):
+        """
+        Stops the workers (even if some already died) and releases the shared memory
+        :return:
+        """
+        try:
+            for connection in self.connections:
+                try:
+                    connection.send(('stop', ()))
+                except (BrokenPipeError, EOFError, OSError):
+                    pass
+                connection.close()
+            for worker in self.workers:
+                worker.join(timeout=k_join_timeout)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+        finally:
+            for shm in self.shared_memories:
+                shm.close()
+                shm.unlink()
+            self.connections     = []
+            self.workers         = []
+            self.shared_memories = []
+
+
+def run_shard(connection, class_name, parameters, arrays):
+    """
+    Worker process loop: executes the commands received over connection on its shard. Commands with a reply get
+    (k_ok, result) or (k_error, exception); the error of a command without reply is sent with the next reply
+    :param connection:
+    :param class_name: SDM class of the shard
+    :param parameters: parameters to create the SDM (see SDM.get_parameters)
+    :param arrays: shared memory specification of addresses and counters
+    :return:
+    """
+    shared_memories = [shared_memory.SharedMemory(name=name) for name, _, _ in arrays]
+    addresses, counters = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                           for shm, (_, shape, dtype) in zip(shared_memories, arrays)]
+    sdm = SDM.SDM.create_from_parameters(class_name, parameters)
+    sdm.store.set_arrays(addresses, counters)
+    error = None
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            break
+        if command == 'stop':
+            break
+        try:
+            result = getattr(sdm, command)(*args)
+        except Exception as e:
+            result = None
+            error  = e if error is None else error
+        if command in ShardedSDM.replies:
+            send_reply(connection, result, error)
+            error = None
+    del sdm, addresses, counters
+    for shm in shared_memories:
+        shm.close()
+
+
+def send_reply(connection, result, error):
+    if error is None:
+        connection.send((k_ok, result))
+        return
+    try:
+        connection.send((k_error, error))
+    except Exception:
+        # not picklable
+        connection.send((k_error, Exception('%s: %s' % (type(error).__name__, error))))
+
+
+def create_shared_array(array):
+    """
+    Copies array in a new shared memory block
+    :param array:
+    :return: the shared memory and its specification (name, shape, dtype) to be attached from other process
+    """
+    shm    = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+# Tests
+def test_sharded_read(sdm_name, number_of_shards, writes_n, array_values=False):
+    """
+    Returns True if a ShardedSDM reads (one by one and in batch) the same values as the SDM it was created from
+    """
+    if sdm_name == 'PackedBinarySDM':
+        sdm = SDM.PackedBinarySDM(32, 8, 400, 12, hard_location_creation=SDM.HardLocationCreation.Random,
+                                  array_values=array_values)
+        contents = [''.join(np.random.choice(['0', '1'], 8)) for _ in range(writes_n)]
+    else:
+        sdm = SDM.ArrayArithmeticSDM(4, 4, 400, 150, learning_rate=0.5,
+                                     hard_location_creation=SDM.HardLocationCreation.Random, array_values=array_values)
+        contents = [sdm.create_random_address().value for _ in range(writes_n)]
+    addresses = [sdm.create_random_address().value for _ in range(writes_n)]
+    with ShardedSDM(sdm, number_of_shards=number_of_shards) as sharded:
+        for address, content in zip(addresses, contents):
+            sdm.write(address, content)
+            sharded.write(address, content)
+        reads   = [[sdm.read(address) for address in addresses], [sharded.read(address) for address in addresses]]
+        batches = [sdm.read_many(addresses), sharded.read_many(addresses)]
+    if array_values:
+        # same type too: one array per read and a 2-D array per batch
+        return all(np.array_equal(value1, value2) for value1, value2 in zip(*reads)) and \
+            type(batches[0]) is type(batches[1]) and np.array_equal(*batches)
+    return reads[0] == reads[1] and batches[0] == batches[1]
+
+
+def test_sharded_read_mode(read_mode, k):
+    """
+    Returns True if a ShardedSDM can not be created from an SDM whose reads are not the hard locations in radius
+    """
+    sdm = SDM.PackedBinarySDM(32, 8, 400, 12, hard_location_creation=SDM.HardLocationCreation.Random)
+    sdm.set_read_mode(read_mode, k)
+    try:
+        ShardedSDM(sdm, number_of_shards=4).close()
+    except Exception:
+        return True
+    return False
+
+
+def test_sharded_error(number_of_shards):
+    """
+    Returns the error raised by reading an invalid address in a ShardedSDM, if the write of an invalid address is
+    reported by the next read, and if it still reads as the SDM it was created from
+    """
+    sdm = SDM.ArrayArithmeticSDM(4, 4, 100, 150, hard_location_creation=SDM.HardLocationCreation.Random, seed=1)
+    with ShardedSDM(sdm, number_of_shards=number_of_shards) as sharded:
+        errors = []
+        for operation in [lambda: sharded.read([1, 2, 3]), lambda: sharded.write([1, 2, 3], [1, 2, 3, 4]),
+                          lambda: sharded.read([1, 2, 3, 4])]:
+            try:
+                operation()
+            except ValueError as e:
+                errors.append(type(e).__name__)
+        same = sharded.read([1, 2, 3, 4]) == sdm.read([1, 2, 3, 4])
+    return [errors, same]
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/sharded_sdm.test', '')